@@ -0,0 +1,74 @@
+-- ============================================
+-- Migration: Index HNSW pour la recherche vectorielle RAG
+-- ============================================
+
+-- Les index pgvector sur le type vector sont limités à 2000 dimensions :
+-- l'index ivfflat sur vector(3072) ne peut pas être utilisé.
+DROP INDEX IF EXISTS "knowledge_chunks_embedding_idx";
+DROP INDEX IF EXISTS "idx_knowledge_chunks_embedding";
+
+-- Embeddings stockés en halfvec (FP16) et réduits à 1024 dimensions : une
+-- seule réécriture de la table. text-embedding-3-large est entraîné en
+-- Matryoshka : les 1024 premières composantes, renormalisées, sont
+-- équivalentes à un appel OpenAI avec dimensions=1024, les embeddings
+-- existants sont donc convertis sans nouvelle vectorisation.
+ALTER TABLE "knowledge_chunks"
+    ALTER COLUMN "embedding" TYPE halfvec(1024)
+    USING l2_normalize(subvector("embedding", 1, 1024))::halfvec(1024);
+
+-- Construction parallèle et en mémoire du graphe HNSW
+SET max_parallel_maintenance_workers = 7;
+SET maintenance_work_mem = '2GB';
+
+-- Embeddings normalisés : cosinus = produit scalaire, l'opérateur <#>
+-- évite le calcul des normes pour chaque candidat.
+-- m=24 / ef_construction=128 : meilleur rappel que les valeurs par défaut (16/64)
+CREATE INDEX IF NOT EXISTS "idx_knowledge_chunks_embedding_hnsw"
+    ON "knowledge_chunks"
+    USING hnsw (embedding halfvec_ip_ops)
+    WITH (m = 24, ef_construction = 128);
+
+RESET max_parallel_maintenance_workers;
+RESET maintenance_work_mem;
+
+-- ============================================
+-- Fonction de recherche vectorielle (utilise l'index HNSW)
+-- ============================================
+DROP FUNCTION IF EXISTS match_knowledge_chunks(vector, float, int);
+
+CREATE OR REPLACE FUNCTION match_knowledge_chunks(
+    query_embedding halfvec(1024),
+    match_threshold float DEFAULT 0.75,
+    match_count int DEFAULT 5,
+    ef_search int DEFAULT 100
+)
+RETURNS TABLE(
+    id uuid,
+    document_id uuid,
+    content text,
+    metadata jsonb,
+    similarity float,
+    document_name text
+)
+LANGUAGE plpgsql
+AS $$
+BEGIN
+    -- Taille de la liste de candidats HNSW, limitée à la transaction courante
+    PERFORM set_config('hnsw.ef_search', ef_search::text, true);
+
+    -- <#> renvoie l'opposé du produit scalaire (embeddings normalisés)
+    RETURN QUERY
+    SELECT
+        kc.id,
+        kc.document_id,
+        kc.content,
+        kc.metadata,
+        (-(kc.embedding <#> query_embedding))::float as similarity,
+        kd.name as document_name
+    FROM knowledge_chunks kc
+    JOIN knowledge_documents kd ON kc.document_id = kd.id
+    WHERE -(kc.embedding <#> query_embedding) > match_threshold
+    ORDER BY kc.embedding <#> query_embedding
+    LIMIT match_count;
+END;
+$$;
@@ -0,0 +1,22 @@
+-- ============================================
+-- Migration: Statistiques RAG agrégées côté serveur
+-- ============================================
+
+-- Un seul appel RPC au lieu de trois requêtes (dont une qui rapatriait
+-- le statut de tous les documents pour les compter en Python).
+CREATE OR REPLACE FUNCTION rag_stats()
+RETURNS json
+LANGUAGE sql
+STABLE
+AS $$
+    SELECT json_build_object(
+        'total_documents', (SELECT count(*) FROM knowledge_documents),
+        'total_chunks', (SELECT count(*) FROM knowledge_chunks),
+        'status_breakdown', COALESCE(
+            (SELECT json_object_agg(status, c)
+             FROM (SELECT COALESCE(status, 'UNKNOWN') AS status, count(*) AS c
+                   FROM knowledge_documents GROUP BY 1) s),
+            '{}'::json
+        )
+    );
+$$;
@@ -0,0 +1,13 @@
+-- ============================================
+-- Migration: Finalisation de l'indexation d'un document
+-- ============================================
+
+-- Passage au statut INDEXED avec l'horodatage du serveur, en un appel RPC.
+CREATE OR REPLACE FUNCTION finalize_document(doc_id uuid)
+RETURNS void
+LANGUAGE sql
+AS $$
+    UPDATE knowledge_documents
+    SET status = 'INDEXED', indexed_at = NOW()
+    WHERE id = doc_id;
+$$;
@@ -0,0 +1,69 @@
+-- ============================================
+-- Migration: Métadonnées au niveau du document RAG
+-- ============================================
+
+-- Les métadonnées communes à tous les chunks (fichier source, etc.) sont
+-- stockées une seule fois sur le document ; chaque chunk ne garde que les
+-- siennes (page, position). Elles sont fusionnées à la recherche.
+ALTER TABLE "knowledge_documents"
+    ADD COLUMN IF NOT EXISTS "metadata" JSONB DEFAULT '{}';
+
+CREATE OR REPLACE FUNCTION match_knowledge_chunks(
+    query_embedding halfvec(1024),
+    match_threshold float DEFAULT 0.75,
+    match_count int DEFAULT 5,
+    ef_search int DEFAULT 100,
+    filter_doc_type text DEFAULT NULL,
+    filter_doc_ids uuid[] DEFAULT NULL
+)
+RETURNS TABLE(
+    id uuid,
+    document_id uuid,
+    content text,
+    metadata jsonb,
+    similarity float,
+    document_name text
+)
+LANGUAGE plpgsql
+AS $$
+DECLARE
+    -- Avec un filtre, l'index renvoie des candidats en excès (filtrage après
+    -- le parcours HNSW) pour conserver match_count résultats
+    candidate_count int := CASE
+        WHEN filter_doc_type IS NULL AND filter_doc_ids IS NULL THEN match_count
+        ELSE match_count * 3
+    END;
+BEGIN
+    -- Taille de la liste de candidats HNSW, limitée à la transaction courante
+    PERFORM set_config('hnsw.ef_search', greatest(ef_search, candidate_count)::text, true);
+
+    -- <#> renvoie l'opposé du produit scalaire (embeddings normalisés)
+    RETURN QUERY
+    WITH candidates AS (
+        SELECT
+            kc.id,
+            kc.document_id,
+            kc.content,
+            kc.metadata,
+            kc.embedding <#> query_embedding AS distance
+        FROM knowledge_chunks kc
+        ORDER BY kc.embedding <#> query_embedding
+        LIMIT candidate_count
+    )
+    SELECT
+        c.id,
+        c.document_id,
+        c.content,
+        -- Métadonnées du document complétées par celles propres au chunk
+        kd.metadata || c.metadata as metadata,
+        (-c.distance)::float as similarity,
+        kd.name as document_name
+    FROM candidates c
+    JOIN knowledge_documents kd ON c.document_id = kd.id
+    WHERE -c.distance > match_threshold
+      AND (filter_doc_type IS NULL OR kd.type = filter_doc_type)
+      AND (filter_doc_ids IS NULL OR c.document_id = ANY(filter_doc_ids))
+    ORDER BY c.distance
+    LIMIT match_count;
+END;
+$$;
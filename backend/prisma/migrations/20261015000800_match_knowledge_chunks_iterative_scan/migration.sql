@@ -0,0 +1,80 @@
+-- ============================================
+-- Migration: Recherche vectorielle filtrée par parcours itératif HNSW
+-- ============================================
+
+-- Les filtres étaient appliqués à 3 x match_count plus proches voisins
+-- globaux : pour un document précis dans un grand corpus, aucun ne
+-- subsistait. Ils sont maintenant appliqués dans la requête ordonnée par
+-- l'index, avec hnsw.iterative_scan (pgvector >= 0.8).
+
+-- hnsw.iterative_scan n'existe qu'à partir de pgvector 0.8.0 : sur une
+-- version antérieure, set_config échouerait à chaque recherche
+DO $$
+BEGIN
+    IF (SELECT string_to_array(extversion, '.')::int[] FROM pg_extension WHERE extname = 'vector')
+        < ARRAY[0, 8, 0] THEN
+        RAISE EXCEPTION 'pgvector >= 0.8.0 requis (ALTER EXTENSION vector UPDATE)';
+    END IF;
+END;
+$$;
+
+CREATE OR REPLACE FUNCTION match_knowledge_chunks(
+    query_embedding halfvec(1024),
+    match_threshold float DEFAULT 0.75,
+    match_count int DEFAULT 5,
+    ef_search int DEFAULT 100,
+    filter_doc_type text DEFAULT NULL,
+    filter_doc_ids uuid[] DEFAULT NULL
+)
+RETURNS TABLE(
+    id uuid,
+    document_id uuid,
+    content text,
+    metadata jsonb,
+    similarity float,
+    document_name text
+)
+LANGUAGE plpgsql
+AS $$
+BEGIN
+    -- Taille de la liste de candidats HNSW, limitée à la transaction courante
+    PERFORM set_config('hnsw.ef_search', ef_search::text, true);
+    -- Parcours itératif (pgvector >= 0.8) : tant que les filtres écartent
+    -- des candidats, l'index continue d'en fournir jusqu'à obtenir
+    -- match_count lignes
+    PERFORM set_config('hnsw.iterative_scan', 'relaxed_order', true);
+
+    -- <#> renvoie l'opposé du produit scalaire (embeddings normalisés).
+    -- En relaxed_order l'ordre de l'index est approximatif : les candidats
+    -- sont matérialisés puis triés à nouveau.
+    RETURN QUERY
+    WITH candidates AS MATERIALIZED (
+        SELECT
+            kc.id,
+            kc.document_id,
+            kc.content,
+            kc.metadata,
+            kc.embedding <#> query_embedding AS distance
+        FROM knowledge_chunks kc
+        WHERE (filter_doc_ids IS NULL OR kc.document_id = ANY(filter_doc_ids))
+          AND (filter_doc_type IS NULL OR kc.document_id IN (
+              SELECT kd_type.id FROM knowledge_documents kd_type
+              WHERE kd_type.type = filter_doc_type
+          ))
+        ORDER BY kc.embedding <#> query_embedding
+        LIMIT match_count
+    )
+    SELECT
+        c.id,
+        c.document_id,
+        c.content,
+        -- Métadonnées du document complétées par celles propres au chunk
+        kd.metadata || c.metadata as metadata,
+        (-c.distance)::float as similarity,
+        kd.name as document_name
+    FROM candidates c
+    JOIN knowledge_documents kd ON c.document_id = kd.id
+    WHERE -c.distance > match_threshold
+    ORDER BY c.distance;
+END;
+$$;
@@ -0,0 +1,71 @@
+-- ============================================
+-- Migration: Métadonnées du document jamais NULL
+-- ============================================
+
+-- jsonb || NULL vaut NULL : un document sans métadonnées faisait perdre
+-- celles de ses chunks (page, position) dans les résultats de recherche.
+UPDATE "knowledge_documents" SET "metadata" = '{}' WHERE "metadata" IS NULL;
+
+ALTER TABLE "knowledge_documents"
+    ALTER COLUMN "metadata" SET NOT NULL;
+
+CREATE OR REPLACE FUNCTION match_knowledge_chunks(
+    query_embedding halfvec(1024),
+    match_threshold float DEFAULT 0.75,
+    match_count int DEFAULT 5,
+    ef_search int DEFAULT 100,
+    filter_doc_type text DEFAULT NULL,
+    filter_doc_ids uuid[] DEFAULT NULL
+)
+RETURNS TABLE(
+    id uuid,
+    document_id uuid,
+    content text,
+    metadata jsonb,
+    similarity float,
+    document_name text
+)
+LANGUAGE plpgsql
+AS $$
+BEGIN
+    -- Taille de la liste de candidats HNSW, limitée à la transaction courante
+    PERFORM set_config('hnsw.ef_search', ef_search::text, true);
+    -- Parcours itératif (pgvector >= 0.8) : tant que les filtres écartent
+    -- des candidats, l'index continue d'en fournir jusqu'à obtenir
+    -- match_count lignes
+    PERFORM set_config('hnsw.iterative_scan', 'relaxed_order', true);
+
+    -- <#> renvoie l'opposé du produit scalaire (embeddings normalisés).
+    -- En relaxed_order l'ordre de l'index est approximatif : les candidats
+    -- sont matérialisés puis triés à nouveau.
+    RETURN QUERY
+    WITH candidates AS MATERIALIZED (
+        SELECT
+            kc.id,
+            kc.document_id,
+            kc.content,
+            kc.metadata,
+            kc.embedding <#> query_embedding AS distance
+        FROM knowledge_chunks kc
+        WHERE (filter_doc_ids IS NULL OR kc.document_id = ANY(filter_doc_ids))
+          AND (filter_doc_type IS NULL OR kc.document_id IN (
+              SELECT kd_type.id FROM knowledge_documents kd_type
+              WHERE kd_type.type = filter_doc_type
+          ))
+        ORDER BY kc.embedding <#> query_embedding
+        LIMIT match_count
+    )
+    SELECT
+        c.id,
+        c.document_id,
+        c.content,
+        -- Métadonnées du document complétées par celles propres au chunk
+        COALESCE(kd.metadata, '{}') || COALESCE(c.metadata, '{}') as metadata,
+        (-c.distance)::float as similarity,
+        kd.name as document_name
+    FROM candidates c
+    JOIN knowledge_documents kd ON c.document_id = kd.id
+    WHERE -c.distance > match_threshold
+    ORDER BY c.distance;
+END;
+$$;
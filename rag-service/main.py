@@ -1,10 +1,15 @@
 import os
 import uuid
+import asyncio
+import time
 from typing import List, Optional
 from contextlib import asynccontextmanager
 
-from fastapi import FastAPI, UploadFile, File, HTTPException, BackgroundTasks
+import aiofiles
+import orjson
+from fastapi import FastAPI, UploadFile, File, HTTPException
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.responses import ORJSONResponse, StreamingResponse
 from pydantic import BaseModel
 from dotenv import load_dotenv
 
@@ -14,6 +19,16 @@ from utils.logger import logger
 
 load_dotenv()
 
+# Taille des blocs lus lors de l'écriture des fichiers uploadés
+UPLOAD_CHUNK_SIZE = 1 << 20
+
+# Nombre maximum de messages acceptés par /chat/batch
+MAX_CHAT_BATCH_SIZE = 48
+
+# Ingestion des documents : taille de la file d'attente et nombre de workers
+INGEST_QUEUE_SIZE = 64
+INGEST_WORKERS = int(os.getenv("INGEST_WORKERS", "2"))
+
 # Lifespan context manager for startup/shutdown events
 @asynccontextmanager
 async def lifespan(app: FastAPI):
@@ -22,18 +37,47 @@ async def lifespan(app: FastAPI):
     try:
         app.state.rag_service = SupabaseRAGService()
         app.state.doc_processor = DocumentProcessor()
+        
+        # Ajuster ef_search à la taille actuelle du corpus (sans bloquer le
+        # démarrage si la base est indisponible)
+        await app.state.rag_service.refresh_hnsw_params()
+        
+        # File d'ingestion consommée par un nombre borné de workers
+        app.state.ingest_queue = asyncio.Queue(maxsize=INGEST_QUEUE_SIZE)
+        app.state.ingest_workers = [
+            asyncio.create_task(ingest_worker(
+                app.state.ingest_queue,
+                app.state.doc_processor,
+                app.state.rag_service
+            ))
+            for _ in range(INGEST_WORKERS)
+        ]
         logger.info("✅ Services initialisés avec succès")
     except Exception as e:
-        logger.error(f"❌ Erreur lors du démarrage: {e}")
+        logger.error("❌ Erreur lors du démarrage: %s", e)
         raise
     yield
     # Shutdown
     logger.info("🛑 Arrêt du service RAG...")
+    for worker in app.state.ingest_workers:
+        worker.cancel()
+    await asyncio.gather(*app.state.ingest_workers, return_exceptions=True)
+    
+    # Documents jamais traités : supprimer leurs fichiers temporaires
+    while not app.state.ingest_queue.empty():
+        job = app.state.ingest_queue.get_nowait()
+        logger.warning("Dropping queued document %s (%s) on shutdown", job["doc_id"], job["filename"])
+        try:
+            os.unlink(job["file_path"])
+        except FileNotFoundError:
+            pass
+    await app.state.rag_service.close()
 
 app = FastAPI(
     title="CNSS RAG Service - Supabase",
     description="Service RAG pour le chatbot CNSS WhatsApp utilisant Supabase pgvector",
     version="2.0.0",
+    default_response_class=ORJSONResponse,
     lifespan=lifespan
 )
 
@@ -87,7 +131,7 @@ async def health_check():
             "stats": stats
         }
     except Exception as e:
-        logger.error(f"Health check failed: {e}")
+        logger.error("Health check failed: %s", e)
         raise HTTPException(status_code=503, detail=f"Service unhealthy: {str(e)}")
 
 @app.post("/chat", response_model=ChatResponse)
@@ -95,7 +139,6 @@ async def chat(message: ChatMessage):
     """
     Envoyer un message au chatbot RAG
     """
-    import time
     start_time = time.time()
     
     try:
@@ -110,11 +153,10 @@ async def chat(message: ChatMessage):
         
         processing_time = time.time() - start_time
         
-        logger.info(f"Chat query processed", {
-            "session_id": session_id,
-            "confidence": result["confidence"],
-            "processing_time": processing_time
-        })
+        logger.info(
+            "Chat query processed: session=%s confidence=%.3f time=%.3fs",
+            session_id, result["confidence"], processing_time
+        )
         
         return ChatResponse(
             response=result["response"],
@@ -125,14 +167,83 @@ async def chat(message: ChatMessage):
         )
         
     except Exception as e:
-        logger.error(f"Error processing chat query: {str(e)}")
+        logger.error("Error processing chat query: %s", e)
         raise HTTPException(status_code=500, detail=str(e))
 
+@app.post("/chat/batch", response_model=List[ChatResponse])
+async def chat_batch(messages: List[ChatMessage]):
+    """
+    Envoyer plusieurs messages au chatbot RAG en une seule requête
+    """
+    start_time = time.time()
+    
+    if not messages:
+        raise HTTPException(status_code=400, detail="Aucun message fourni")
+    
+    if len(messages) > MAX_CHAT_BATCH_SIZE:
+        raise HTTPException(
+            status_code=400,
+            detail=f"Trop de messages: maximum {MAX_CHAT_BATCH_SIZE} par requête"
+        )
+    
+    try:
+        session_ids = [m.session_id or str(uuid.uuid4()) for m in messages]
+        
+        results = await app.state.rag_service.query_batch(
+            questions=[m.message for m in messages],
+            session_ids=session_ids
+        )
+        
+        processing_time = time.time() - start_time
+        
+        logger.info("Batch of %s chat queries processed in %.3fs", len(messages), processing_time)
+        
+        return [
+            ChatResponse(
+                response=result["response"],
+                sources=result["sources"],
+                confidence=result["confidence"],
+                session_id=session_id,
+                processing_time=round(processing_time, 3)
+            )
+            for result, session_id in zip(results, session_ids)
+        ]
+        
+    except Exception as e:
+        logger.error("Error processing chat batch: %s", e)
+        raise HTTPException(status_code=500, detail=str(e))
+
+@app.post("/chat/stream")
+async def chat_stream(message: ChatMessage):
+    """
+    Envoyer un message au chatbot RAG et recevoir la réponse en Server-Sent Events.
+    
+    Le premier événement contient les sources et la confiance, les suivants
+    les fragments de la réponse ; le flux se termine par un événement "done".
+    """
+    session_id = message.session_id or str(uuid.uuid4())
+    
+    async def event_stream():
+        try:
+            async for event in app.state.rag_service.stream_query(
+                question=message.message,
+                session_id=session_id
+            ):
+                yield b"data: " + orjson.dumps(event) + b"\n\n"
+        except Exception as e:
+            logger.error("Error streaming chat query: %s", e)
+            yield b"data: " + orjson.dumps({"type": "error", "detail": str(e)}) + b"\n\n"
+        
+        yield b"data: " + orjson.dumps({"type": "done"}) + b"\n\n"
+    
+    return StreamingResponse(
+        event_stream(),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+    )
+
 @app.post("/documents/upload")
-async def upload_document(
-    background_tasks: BackgroundTasks,
-    file: UploadFile = File(...)
-):
+async def upload_document(file: UploadFile = File(...)):
     """
     Uploader et indexer un document
     """
@@ -147,34 +258,42 @@ async def upload_document(
                 detail=f"Type de fichier non supporté. Types autorisés: {', '.join(allowed_extensions)}"
             )
         
+        # Refuser tout de suite si la file d'ingestion est saturée
+        if app.state.ingest_queue.full():
+            raise HTTPException(
+                status_code=503,
+                detail="Trop de documents en cours d'indexation, réessayez plus tard"
+            )
+        
         # Générer un ID unique
         doc_id = str(uuid.uuid4())
         
-        # Sauvegarder le fichier temporairement
+        # Sauvegarder le fichier temporairement, par blocs
         temp_path = f"/tmp/{doc_id}_{file.filename}"
-        with open(temp_path, "wb") as buffer:
-            content = await file.read()
-            buffer.write(content)
-        
-        # Lire le contenu pour la taille
-        file_content = content.decode('utf-8', errors='ignore')
+        file_size = 0
+        async with aiofiles.open(temp_path, "wb") as buffer:
+            while chunk := await file.read(UPLOAD_CHUNK_SIZE):
+                await buffer.write(chunk)
+                file_size += len(chunk)
         
-        # Traiter le document en arrière-plan
-        background_tasks.add_task(
-            process_document_task,
-            app.state.doc_processor,
-            app.state.rag_service,
-            temp_path,
-            doc_id,
-            file.filename,
-            file_ext,
-            file_content
-        )
+        # Mettre le document en file d'attente (la file a pu se remplir
+        # pendant la réception du fichier)
+        try:
+            app.state.ingest_queue.put_nowait({
+                "file_path": temp_path,
+                "doc_id": doc_id,
+                "filename": file.filename,
+                "file_ext": file_ext,
+                "file_size": file_size
+            })
+        except asyncio.QueueFull:
+            os.unlink(temp_path)
+            raise HTTPException(
+                status_code=503,
+                detail="Trop de documents en cours d'indexation, réessayez plus tard"
+            )
         
-        logger.info(f"Document upload started", {
-            "doc_id": doc_id,
-            "filename": file.filename
-        })
+        logger.info("Document upload started: doc_id=%s filename=%s", doc_id, file.filename)
         
         return {
             "id": doc_id,
@@ -186,15 +305,15 @@ async def upload_document(
     except HTTPException:
         raise
     except Exception as e:
-        logger.error(f"Error uploading document: {str(e)}")
+        logger.error("Error uploading document: %s", e)
         raise HTTPException(status_code=500, detail=str(e))
 
-async def process_document_task(doc_processor, rag_service, file_path, doc_id, filename, file_ext, file_content):
+async def process_document_task(doc_processor, rag_service, file_path, doc_id, filename, file_ext, file_size):
     """
     Tâche de traitement du document en arrière-plan
     """
     try:
-        logger.info(f"Processing document {doc_id}")
+        logger.info("Processing document %s", doc_id)
         
         # Traiter le document (extraire les chunks)
         result = await doc_processor.process(file_path, file_ext)
@@ -203,24 +322,33 @@ async def process_document_task(doc_processor, rag_service, file_path, doc_id, f
         await rag_service.index_document(
             doc_id=doc_id,
             filename=filename,
-            content=file_content,
+            size=file_size,
             doc_type=file_ext,
             chunks=result["chunks"]
         )
         
-        # Nettoyer le fichier temporaire
-        import os
-        if os.path.exists(file_path):
-            os.remove(file_path)
-        
-        logger.info(f"Document {doc_id} indexed successfully with {len(result['chunks'])} chunks")
+        logger.info("Document %s indexed successfully with %s chunks", doc_id, len(result['chunks']))
         
     except Exception as e:
-        logger.error(f"Error processing document {doc_id}: {str(e)}")
-        # Nettoyer en cas d'erreur
-        import os
-        if os.path.exists(file_path):
-            os.remove(file_path)
+        logger.error("Error processing document %s: %s", doc_id, e)
+    
+    finally:
+        # Nettoyer le fichier temporaire
+        try:
+            os.unlink(file_path)
+        except FileNotFoundError:
+            pass
+
+async def ingest_worker(queue: asyncio.Queue, doc_processor, rag_service):
+    """
+    Worker d'ingestion : traite les documents de la file un par un
+    """
+    while True:
+        job = await queue.get()
+        try:
+            await process_document_task(doc_processor, rag_service, **job)
+        finally:
+            queue.task_done()
 
 @app.get("/documents")
 async def list_documents():
@@ -231,7 +359,7 @@ async def list_documents():
         documents = await app.state.rag_service.list_documents()
         return {"documents": documents}
     except Exception as e:
-        logger.error(f"Error listing documents: {str(e)}")
+        logger.error("Error listing documents: %s", e)
         raise HTTPException(status_code=500, detail=str(e))
 
 @app.get("/documents/{doc_id}")
@@ -247,7 +375,7 @@ async def get_document(doc_id: str):
     except HTTPException:
         raise
     except Exception as e:
-        logger.error(f"Error getting document {doc_id}: {str(e)}")
+        logger.error("Error getting document %s: %s", doc_id, e)
         raise HTTPException(status_code=500, detail=str(e))
 
 @app.delete("/documents/{doc_id}")
@@ -258,12 +386,12 @@ async def delete_document(doc_id: str):
     try:
         await app.state.rag_service.delete_document(doc_id)
         
-        logger.info(f"Document deleted", {"doc_id": doc_id})
+        logger.info("Document deleted: %s", doc_id)
         
         return {"success": True, "message": "Document supprimé avec succès"}
         
     except Exception as e:
-        logger.error(f"Error deleting document {doc_id}: {str(e)}")
+        logger.error("Error deleting document %s: %s", doc_id, e)
         raise HTTPException(status_code=500, detail=str(e))
 
 @app.post("/config")
@@ -280,12 +408,12 @@ async def update_config(config: RAGConfig):
             "similarity_threshold": config.similarity_threshold
         })
         
-        logger.info("RAG configuration updated", config.dict())
+        logger.info("RAG configuration updated: %s", config)
         
         return {"success": True, "message": "Configuration mise à jour"}
         
     except Exception as e:
-        logger.error(f"Error updating config: {str(e)}")
+        logger.error("Error updating config: %s", e)
         raise HTTPException(status_code=500, detail=str(e))
 
 @app.get("/config")
@@ -297,7 +425,7 @@ async def get_config():
         config = app.state.rag_service.get_config()
         return config
     except Exception as e:
-        logger.error(f"Error getting config: {str(e)}")
+        logger.error("Error getting config: %s", e)
         raise HTTPException(status_code=500, detail=str(e))
 
 @app.get("/stats")
@@ -309,19 +437,22 @@ async def get_stats():
         stats = await app.state.rag_service.get_stats()
         return stats
     except Exception as e:
-        logger.error(f"Error getting stats: {str(e)}")
+        logger.error("Error getting stats: %s", e)
         raise HTTPException(status_code=500, detail=str(e))
 
 @app.post("/search")
-async def search(query: str, top_k: int = 5):
+async def search(query: str, top_k: int = 5, doc_type: Optional[str] = None):
     """
     Recherche sémantique directe (pour debug)
+
+    doc_type est l'extension du fichier, point inclus (ex: ".pdf").
     """
     try:
-        results = await app.state.rag_service.search_similar(query, top_k)
+        filters = {"doc_type": doc_type} if doc_type else None
+        results = await app.state.rag_service.search_similar(query, top_k, filters)
         return {"results": results}
     except Exception as e:
-        logger.error(f"Error in search: {str(e)}")
+        logger.error("Error in search: %s", e)
         raise HTTPException(status_code=500, detail=str(e))
 
 if __name__ == "__main__":
@@ -330,5 +461,8 @@ if __name__ == "__main__":
         "main:app",
         host="0.0.0.0",
         port=int(os.getenv("PORT", 8000)),
-        reload=os.getenv("ENV", "production") == "development"
+        reload=os.getenv("ENV", "production") == "development",
+        loop="uvloop",
+        http="httptools",
+        workers=int(os.getenv("WORKERS", 2))
     )
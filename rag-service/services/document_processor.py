@@ -1,4 +1,5 @@
 import os
+import functools
 from typing import List, Dict, Any
 
 from langchain.schema import Document
@@ -15,6 +16,22 @@ from langchain_community.document_loaders import (
 
 from utils.logger import logger
 
+@functools.lru_cache(maxsize=8)
+def get_text_splitter(chunk_size: int, chunk_overlap: int) -> RecursiveCharacterTextSplitter:
+    """
+    Splitter partagé pour une configuration donnée.
+    
+    Le splitter est sans état : une même instance sert tous les documents,
+    et une mise à jour de configuration aux valeurs inchangées ne le
+    reconstruit pas.
+    """
+    return RecursiveCharacterTextSplitter(
+        chunk_size=chunk_size,
+        chunk_overlap=chunk_overlap,
+        length_function=len,
+        separators=["\n\n", "\n", ". ", " ", ""]
+    )
+
 class DocumentProcessor:
     """
     Processeur de documents pour le RAG.
@@ -24,12 +41,7 @@ class DocumentProcessor:
     def __init__(self, chunk_size: int = 1000, chunk_overlap: int = 200):
         self.chunk_size = chunk_size
         self.chunk_overlap = chunk_overlap
-        self.text_splitter = RecursiveCharacterTextSplitter(
-            chunk_size=chunk_size,
-            chunk_overlap=chunk_overlap,
-            length_function=len,
-            separators=["\n\n", "\n", ". ", " ", ""]
-        )
+        self.text_splitter = get_text_splitter(chunk_size, chunk_overlap)
     
     async def process(self, file_path: str, file_ext: str) -> Dict[str, Any]:
         """
@@ -47,12 +59,12 @@ class DocumentProcessor:
             loader = self._get_loader(file_path, file_ext)
             documents = loader.load()
             
-            logger.info(f"Loaded document with {len(documents)} pages/sections")
+            logger.info("Loaded document with %s pages/sections", len(documents))
             
             # Découper en chunks
             chunks = self.text_splitter.split_documents(documents)
             
-            logger.info(f"Split into {len(chunks)} chunks")
+            logger.info("Split into %s chunks", len(chunks))
             
             return {
                 "chunks": chunks,
@@ -61,7 +73,7 @@ class DocumentProcessor:
             }
             
         except Exception as e:
-            logger.error(f"Error processing document: {str(e)}")
+            logger.error("Error processing document: %s", e)
             raise
     
     def _get_loader(self, file_path: str, file_ext: str):
@@ -109,11 +121,6 @@ class DocumentProcessor:
         if chunk_overlap:
             self.chunk_overlap = chunk_overlap
         
-        self.text_splitter = RecursiveCharacterTextSplitter(
-            chunk_size=self.chunk_size,
-            chunk_overlap=self.chunk_overlap,
-            length_function=len,
-            separators=["\n\n", "\n", ". ", " ", ""]
-        )
+        self.text_splitter = get_text_splitter(self.chunk_size, self.chunk_overlap)
         
-        logger.info(f"Updated chunk config: size={self.chunk_size}, overlap={self.chunk_overlap}")
+        logger.info("Updated chunk config: size=%s, overlap=%s", self.chunk_size, self.chunk_overlap)
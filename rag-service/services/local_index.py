@@ -0,0 +1,139 @@
+from typing import List, Dict, Any, Tuple
+
+import numpy as np
+import faiss
+
+from utils.logger import logger
+
+# Paramètres HNSW de l'index local
+HNSW_M = 32
+HNSW_EF_CONSTRUCTION = 100
+HNSW_EF_SEARCH = 64
+
+# Nombre minimal de vecteurs pour entraîner le quantificateur 8 bits : en
+# dessous, ses bornes par dimension ne sont pas représentatives du corpus
+MIN_TRAINING_VECTORS = 2048
+
+
+def quantize_int8(vectors) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    Quantifier des vecteurs en int8 avec une échelle par vecteur.
+
+    Returns:
+        Tuple (codes int8, échelles float32) tel que vecteur ≈ code * échelle
+    """
+    vectors = np.asarray(vectors, dtype=np.float32)
+    scales = np.abs(vectors).max(axis=1) / 127
+    scales[scales == 0] = 1
+    codes = np.round(vectors / scales[:, None]).astype(np.int8)
+    return codes, scales.astype(np.float32)
+
+
+class LocalANNIndex:
+    """
+    Index ANN en mémoire (FAISS HNSW) pour servir les recherches sans
+    aller-retour réseau vers Pinecone.
+
+    Les vecteurs réduits sont indexés dans FAISS avec un quantificateur
+    scalaire 8 bits ; les vecteurs pleine dimension sont conservés en int8
+    (avec une échelle par vecteur) pour le re-classement. La mémoire occupée
+    est divisée par 4 par rapport au float32.
+    """
+
+    def __init__(self, search_dimensions: int, full_dimensions: int):
+        self.index = faiss.IndexHNSWSQ(
+            search_dimensions,
+            faiss.ScalarQuantizer.QT_8bit,
+            HNSW_M,
+            faiss.METRIC_INNER_PRODUCT
+        )
+        self.index.hnsw.efConstruction = HNSW_EF_CONSTRUCTION
+        self.index.hnsw.efSearch = HNSW_EF_SEARCH
+
+        self.ids: List[str] = []
+        self.metadatas: List[Dict[str, Any]] = []
+        self.full_codes = np.empty((0, full_dimensions), dtype=np.int8)
+        self.full_scales = np.empty(0, dtype=np.float32)
+
+        # Vecteurs réduits conservés en float32 tant que le quantificateur
+        # n'est pas entraîné ; la recherche est alors exhaustive
+        self._pending = np.empty((0, search_dimensions), dtype=np.float32)
+
+        # FAISS HNSW ne supporte pas la suppression : les positions des
+        # vecteurs supprimés sont ignorées à la recherche
+        self._deleted = set()
+
+    def __len__(self) -> int:
+        return len(self.ids) - len(self._deleted)
+
+    def add(self, ids: List[str], short_vectors, full_vectors, metadatas: List[Dict[str, Any]]):
+        """
+        Ajouter des vecteurs à l'index.
+
+        Args:
+            ids: IDs des vecteurs (identiques à ceux de Pinecone)
+            short_vectors: Vecteurs réduits, normalisés
+            full_vectors: Vecteurs pleine dimension
+            metadatas: Métadonnées des chunks
+        """
+        if not ids:
+            return
+
+        short_vectors = np.ascontiguousarray(short_vectors, dtype=np.float32)
+
+        if self.index.is_trained:
+            self.index.add(short_vectors)
+        else:
+            # Le quantificateur n'apprend les bornes de chaque dimension
+            # qu'une fois MIN_TRAINING_VECTORS vecteurs disponibles
+            self._pending = np.concatenate([self._pending, short_vectors])
+            if len(self._pending) >= MIN_TRAINING_VECTORS:
+                self.index.train(self._pending)
+                self.index.add(self._pending)
+                self._pending = self._pending[:0]
+                logger.info("Local index quantizer trained on %s vectors", self.index.ntotal)
+
+        self.ids.extend(ids)
+        self.metadatas.extend(metadatas)
+
+        codes, scales = quantize_int8(full_vectors)
+        self.full_codes = np.concatenate([self.full_codes, codes])
+        self.full_scales = np.concatenate([self.full_scales, scales])
+
+    def search(self, vector: np.ndarray, k: int) -> Tuple[List[str], List[Dict[str, Any]], np.ndarray]:
+        """
+        Rechercher les k plus proches voisins d'un vecteur réduit.
+
+        Returns:
+            Tuple (ids, métadonnées, vecteurs pleine dimension déquantifiés)
+        """
+        vector = np.ascontiguousarray(vector, dtype=np.float32).reshape(1, -1)
+        total = self.index.ntotal if self.index.is_trained else len(self._pending)
+        k_search = min(k + len(self._deleted), total)
+        if k_search == 0:
+            return [], [], np.empty((0, self.full_codes.shape[1]), dtype=np.float32)
+
+        if self.index.is_trained:
+            _, positions = self.index.search(vector, k_search)
+            positions = positions[0]
+        else:
+            # Corpus trop petit pour l'index : recherche exacte
+            positions = np.argsort(-(self._pending @ vector[0]))[:k_search]
+
+        kept = [int(p) for p in positions if p >= 0 and p not in self._deleted][:k]
+
+        return (
+            [self.ids[p] for p in kept],
+            [self.metadatas[p] for p in kept],
+            self.full_codes[kept].astype(np.float32) * self.full_scales[kept, None]
+        )
+
+    def remove_document(self, doc_id: str) -> int:
+        """Marquer comme supprimés les vecteurs d'un document"""
+        prefix = f"{doc_id}#"
+        positions = [i for i, vector_id in enumerate(self.ids) if vector_id.startswith(prefix)]
+        self._deleted.update(positions)
+
+        logger.info("Removed %s vectors of document %s from local index", len(positions), doc_id)
+
+        return len(positions)
@@ -1,22 +1,106 @@
 import os
-from typing import List, Dict, Any, Optional
+import re
+import uuid
+import asyncio
+import functools
+import hashlib
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from typing import List, Dict, Any, Optional, AsyncIterator, Tuple
 import time
 
+import numpy as np
+import redis.asyncio as redis
+from redis import Redis as SyncRedis
 from langchain_openai import OpenAIEmbeddings, ChatOpenAI
-from langchain_pinecone import PineconeVectorStore
 from langchain.chains import RetrievalQA
-from langchain.prompts import PromptTemplate
 from langchain.schema import Document
 from pinecone import Pinecone, ServerlessSpec
 
+from services.local_index import LocalANNIndex
 from utils.logger import logger
 
+# Nombre de vecteurs par requête upsert Pinecone
+UPSERT_BATCH_SIZE = 100
+
+# Dimension native de text-embedding-3-large
+EMBEDDING_DIMENSIONS = 3072
+# Dimension réduite (Matryoshka) utilisée pour la recherche ANN
+SEARCH_DIMENSIONS = 1024
+# Nombre de candidats ANN re-classés en pleine dimension
+RERANK_CANDIDATES = 20
+
+# Threads dédiés aux appels (synchrones) du client Pinecone
+PINECONE_POOL_SIZE = 64
+
+# Namespace unique de l'index pleine dimension (les IDs sont globalement uniques)
+FULL_NAMESPACE = "cnss"
+
+# Cache des embeddings de questions : entrées en mémoire, durée de vie Redis
+EMBEDDING_CACHE_SIZE = 4096
+EMBEDDING_CACHE_TTL = 86400
+
+# Synchronisation de l'index local entre workers : clé Redis de version,
+# incrémentée à chaque écriture, et intervalle minimal entre deux lectures (s)
+LOCAL_INDEX_VERSION_KEY = "rag:local_index:version"
+LOCAL_INDEX_SYNC_INTERVAL = 5
+# Délai avant reconstruction (s) : Pinecone serverless ne rend pas les
+# écritures visibles immédiatement aux lectures
+LOCAL_INDEX_RELOAD_DELAY = 10
+
+# Remplissage initial depuis l'index historique : un seul worker le fait
+# (verrou Redis, expiré après BACKFILL_LOCK_TIMEOUT s), les autres attendent
+# puis voient le marqueur de fin
+BACKFILL_LOCK_KEY = "rag:pinecone_backfill:lock"
+BACKFILL_DONE_KEY = "rag:pinecone_backfill:done"
+BACKFILL_LOCK_TIMEOUT = 3600
+
+NO_ANSWER_MESSAGE = "Je n'ai pas trouvé d'information pertinente dans ma base de connaissances. Je vous invite à contacter le service client au 0770 12 34 56."
+
+_PUNCTUATION_RE = re.compile(r"[^\w\s]")
+_WHITESPACE_RE = re.compile(r"\s+")
+
+
+def normalize_question(question: str) -> str:
+    """Normaliser une question pour la clé de cache (casse, ponctuation, espaces)"""
+    question = _PUNCTUATION_RE.sub(" ", question.lower())
+    return _WHITESPACE_RE.sub(" ", question).strip()
+
+
+def normalize_embeddings(vectors) -> np.ndarray:
+    """
+    Normaliser des embeddings (norme L2 = 1).
+    
+    Les index utilisent le produit scalaire, égal au cosinus uniquement pour
+    des vecteurs unitaires : les embeddings OpenAI le sont déjà, la
+    normalisation est une sécurité.
+    """
+    vectors = np.asarray(vectors, dtype=np.float32)
+    return vectors / np.linalg.norm(vectors, axis=-1, keepdims=True)
+
+
+def truncate_embeddings(vectors) -> np.ndarray:
+    """
+    Réduire des embeddings text-embedding-3 à SEARCH_DIMENSIONS.
+    
+    Les modèles text-embedding-3 sont entraînés en Matryoshka : le préfixe
+    renormalisé d'un embedding équivaut à l'embedding demandé avec
+    `dimensions=SEARCH_DIMENSIONS`, sans second appel à l'API.
+    """
+    return normalize_embeddings(np.asarray(vectors, dtype=np.float32)[..., :SEARCH_DIMENSIONS])
+
+
 class RAGPipeline:
     def __init__(self):
         self.openai_api_key = os.getenv("OPENAI_API_KEY")
         self.pinecone_api_key = os.getenv("PINECONE_API_KEY")
         self.pinecone_environment = os.getenv("PINECONE_ENVIRONMENT", "gcp-starter")
         self.pinecone_index_name = os.getenv("PINECONE_INDEX", "cnss-knowledge")
+        # Namespaces de l'index de recherche, un par catégorie (FAQ, documents,
+        # réglementation...) ; le premier est le namespace par défaut
+        self.namespaces = [
+            ns.strip() for ns in os.getenv("PINECONE_NAMESPACES", "cnss").split(",") if ns.strip()
+        ]
         
         # Configuration par défaut
         self.config = {
@@ -27,12 +111,32 @@ class RAGPipeline:
             "similarity_threshold": 0.75
         }
         
+        # Pool dédié : les requêtes Pinecone ne sont pas en concurrence avec
+        # les autres appels bloquants sur l'exécuteur par défaut
+        self._pool = ThreadPoolExecutor(
+            max_workers=PINECONE_POOL_SIZE,
+            thread_name_prefix="pinecone"
+        )
+        
         # Initialiser les composants
+        self._init_embedding_cache()
         self._init_embeddings()
         self._init_vectorstore()
         self._init_llm()
         self._init_prompt()
     
+    def _init_embedding_cache(self):
+        """
+        Initialiser le cache des embeddings de questions.
+        
+        Cache LRU en mémoire, doublé d'un cache Redis partagé entre les
+        workers si REDIS_URL est défini.
+        """
+        self._emb_cache: OrderedDict = OrderedDict()
+        
+        redis_url = os.getenv("REDIS_URL")
+        self.redis = redis.from_url(redis_url) if redis_url else None
+    
     def _init_embeddings(self):
         """Initialiser le modèle d'embeddings"""
         self.embeddings = OpenAIEmbeddings(
@@ -42,41 +146,275 @@ class RAGPipeline:
         logger.info("Embeddings model initialized")
     
     def _init_vectorstore(self):
-        """Initialiser Pinecone"""
+        """
+        Initialiser Pinecone.
+        
+        Deux index sont utilisés : l'index de recherche "-1024" en
+        SEARCH_DIMENSIONS dimensions, et un index "-full" en pleine dimension
+        qui ne sert qu'à récupérer (fetch) les vecteurs des candidats pour le
+        re-classement. L'index historique (PINECONE_INDEX_NAME, cosinus en
+        pleine dimension) n'est jamais modifié : il sert de source au
+        remplissage initial des deux nouveaux index.
+        """
         try:
             self.pc = Pinecone(api_key=self.pinecone_api_key)
             
-            # Vérifier si l'index existe
-            existing_indexes = [index.name for index in self.pc.list_indexes()]
-            
-            if self.pinecone_index_name not in existing_indexes:
-                # Créer l'index
-                self.pc.create_index(
-                    name=self.pinecone_index_name,
-                    dimension=3072,  # Dimension pour text-embedding-3-large
-                    metric="cosine",
-                    spec=ServerlessSpec(
-                        cloud="aws",
-                        region="us-east-1"
-                    )
-                )
-                logger.info(f"Created Pinecone index: {self.pinecone_index_name}")
+            self.index = self._get_or_create_index(
+                f"{self.pinecone_index_name}-{SEARCH_DIMENSIONS}", SEARCH_DIMENSIONS
+            )
+            self.full_index = self._get_or_create_index(
+                f"{self.pinecone_index_name}-full", EMBEDDING_DIMENSIONS
+            )
             
-            self.index = self.pc.Index(self.pinecone_index_name)
+            logger.info("Pinecone index initialized")
             
-            # Initialiser le vectorstore LangChain
-            self.vectorstore = PineconeVectorStore(
-                index=self.index,
-                embedding=self.embeddings,
-                namespace="cnss"
-            )
+            self._backfill_from_legacy_index()
             
-            logger.info("Pinecone vectorstore initialized")
+            self._init_local_index()
             
         except Exception as e:
-            logger.error(f"Error initializing Pinecone: {str(e)}")
+            logger.error("Error initializing Pinecone: %s", e)
             raise
     
+    def _init_local_index(self):
+        """
+        Charger les vecteurs Pinecone dans un index FAISS en mémoire.
+        
+        Activé par LOCAL_ANN_INDEX=true : les recherches sont alors servies
+        localement et Pinecone ne sert plus que de stockage durable. Chaque
+        worker a son propre index ; REDIS_URL est requis pour propager les
+        ajouts et suppressions de documents aux autres workers.
+        """
+        self.local_index = None
+        self._local_index_version = None
+        self._local_index_checked = 0.0
+        self._local_index_reloading = False
+        self._local_index_enabled = os.getenv("LOCAL_ANN_INDEX", "false").lower() == "true"
+        
+        if not self._local_index_enabled:
+            return
+        
+        if self.redis is None:
+            logger.warning("LOCAL_ANN_INDEX requires REDIS_URL to stay consistent across workers, local index disabled")
+            self._local_index_enabled = False
+            return
+        
+        # Version lue avant le chargement : une écriture d'un autre worker
+        # pendant le chargement déclenchera une reconstruction
+        client = SyncRedis.from_url(os.getenv("REDIS_URL"))
+        try:
+            self._local_index_version = int(client.get(LOCAL_INDEX_VERSION_KEY) or 0)
+        except Exception as e:
+            logger.warning("Local index version unavailable: %s", e)
+        finally:
+            client.close()
+        
+        self.local_index = self._load_local_index()
+        logger.info("Local ANN index loaded with %s vectors", len(self.local_index))
+    
+    def _load_local_index(self) -> LocalANNIndex:
+        """Construire un index local à partir de tous les vecteurs Pinecone"""
+        all_ids, short_vectors, full_vectors, metadatas = [], [], [], []
+        
+        for namespace in self.namespaces:
+            for ids in self.index.list(namespace=namespace):
+                short = self.index.fetch(ids=ids, namespace=namespace).vectors
+                full = self.full_index.fetch(ids=ids, namespace=FULL_NAMESPACE).vectors
+                ids = [i for i in ids if i in short and i in full]
+                
+                all_ids.extend(ids)
+                short_vectors.extend(short[i].values for i in ids)
+                full_vectors.extend(full[i].values for i in ids)
+                metadatas.extend(short[i].metadata for i in ids)
+        
+        # Un seul ajout : le quantificateur int8 est entraîné sur tout le
+        # corpus (recherche exacte tant qu'il est trop petit)
+        local_index = LocalANNIndex(SEARCH_DIMENSIONS, EMBEDDING_DIMENSIONS)
+        local_index.add(all_ids, short_vectors, full_vectors, metadatas)
+        
+        return local_index
+    
+    async def _sync_local_index(self):
+        """
+        Vérifier que l'index local est à jour des écritures des autres workers.
+        
+        Si la version Redis a changé, l'index local est abandonné (les
+        recherches repassent par Pinecone) et reconstruit en arrière-plan.
+        """
+        now = time.monotonic()
+        if not self._local_index_enabled or now - self._local_index_checked < LOCAL_INDEX_SYNC_INTERVAL:
+            return
+        self._local_index_checked = now
+        
+        try:
+            version = int(await self.redis.get(LOCAL_INDEX_VERSION_KEY) or 0)
+        except Exception as e:
+            logger.warning("Local index version unavailable: %s", e)
+            return
+        
+        if self._local_index_version is None:
+            # Version illisible au chargement : référence au premier contrôle
+            self._local_index_version = version
+        elif version != self._local_index_version and not self._local_index_reloading:
+            self._local_index_reloading = True
+            self.local_index = None
+            asyncio.create_task(self._reload_local_index(version))
+    
+    async def _reload_local_index(self, version: int):
+        """
+        Reconstruire l'index local depuis Pinecone.
+        
+        L'index reconstruit n'est retenu que s'il contient autant de vecteurs
+        que Pinecone en annonce ; sinon la version n'est pas marquée à jour
+        et la reconstruction est retentée au contrôle suivant.
+        """
+        try:
+            await asyncio.sleep(LOCAL_INDEX_RELOAD_DELAY)
+            local_index = await self._run(self._load_local_index)
+            expected = await self._run(self._count_search_vectors)
+            
+            if len(local_index) != expected:
+                logger.warning(
+                    "Local ANN index rebuilt with %s vectors but Pinecone reports %s, retrying later",
+                    len(local_index), expected
+                )
+                return
+            
+            self.local_index = local_index
+            self._local_index_version = version
+            logger.info("Local ANN index reloaded with %s vectors (version %s)", len(self.local_index), version)
+        except Exception as e:
+            logger.error("Error reloading local ANN index: %s", e)
+        finally:
+            self._local_index_reloading = False
+    
+    def _count_search_vectors(self) -> int:
+        """Nombre de vecteurs de l'index de recherche dans les namespaces configurés"""
+        namespaces = self.index.describe_index_stats().namespaces
+        return sum(namespaces[ns].vector_count for ns in self.namespaces if ns in namespaces)
+    
+    async def _bump_local_index_version(self):
+        """Signaler aux autres workers que le contenu des index a changé"""
+        if not self._local_index_enabled:
+            return
+        
+        try:
+            version = await self.redis.incr(LOCAL_INDEX_VERSION_KEY)
+        except Exception as e:
+            logger.warning("Could not publish local index version: %s", e)
+            return
+        
+        # Ce worker a déjà appliqué sa propre écriture
+        if self._local_index_version is not None and version == self._local_index_version + 1:
+            self._local_index_version = version
+    
+    def _backfill_from_legacy_index(self):
+        """
+        Remplir les nouveaux index à partir de l'index historique.
+        
+        Avec plusieurs workers, REDIS_URL garantit qu'un seul d'entre eux
+        copie le corpus : les autres attendent la fin sur le verrou.
+        """
+        redis_url = os.getenv("REDIS_URL")
+        if not redis_url:
+            self._copy_legacy_index()
+            return
+        
+        client = SyncRedis.from_url(redis_url)
+        try:
+            if client.get(BACKFILL_DONE_KEY):
+                return
+            
+            with client.lock(BACKFILL_LOCK_KEY, timeout=BACKFILL_LOCK_TIMEOUT):
+                # Un autre worker a pu terminer pendant l'attente du verrou
+                if client.get(BACKFILL_DONE_KEY):
+                    return
+                
+                self._copy_legacy_index()
+                client.set(BACKFILL_DONE_KEY, 1)
+        finally:
+            client.close()
+    
+    def _copy_legacy_index(self):
+        """
+        Copier les vecteurs de l'index historique dans les nouveaux index.
+        
+        Les vecteurs historiques sont les embeddings text-embedding-3-large
+        en pleine dimension : ils sont copiés tels quels (normalisés) dans
+        l'index "-full", et tronqués pour l'index de recherche, sans nouvel
+        appel OpenAI. La copie n'a lieu que si l'index de recherche est
+        vide ; les métadonnées d'origine sont conservées et les IDs préfixés
+        par le doc_id, comme ceux des nouveaux documents, pour que
+        delete_document les retrouve.
+        """
+        legacy_name = self.pinecone_index_name
+        if legacy_name not in [index.name for index in self.pc.list_indexes()]:
+            return
+        
+        if self.index.describe_index_stats().total_vector_count > 0:
+            return
+        
+        if self.pc.describe_index(legacy_name).dimension != EMBEDDING_DIMENSIONS:
+            logger.warning(
+                "Legacy Pinecone index %s does not have %s dimensions, documents must be re-indexed",
+                legacy_name, EMBEDDING_DIMENSIONS
+            )
+            return
+        
+        legacy = self.pc.Index(legacy_name)
+        total = 0
+        
+        for legacy_namespace in legacy.describe_index_stats().namespaces:
+            # Namespace par défaut de l'ancien index -> premier namespace configuré
+            namespace = legacy_namespace or self.namespaces[0]
+            
+            for ids in legacy.list(namespace=legacy_namespace):
+                fetched = legacy.fetch(ids=ids, namespace=legacy_namespace).vectors
+                ids = [i for i in ids if i in fetched]
+                if not ids:
+                    continue
+                
+                vectors = normalize_embeddings([fetched[i].values for i in ids])
+                short_vectors = truncate_embeddings(vectors).tolist()
+                metadatas = [fetched[i].metadata or {} for i in ids]
+                new_ids = [
+                    f"{metadata['doc_id']}#{i}" if metadata.get("doc_id") else i
+                    for i, metadata in zip(ids, metadatas)
+                ]
+                
+                self.index.upsert(vectors=list(zip(new_ids, short_vectors, metadatas)), namespace=namespace)
+                self.full_index.upsert(vectors=list(zip(new_ids, vectors.tolist())), namespace=FULL_NAMESPACE)
+                total += len(ids)
+        
+        logger.info("Backfilled %s vectors from legacy Pinecone index %s", total, legacy_name)
+    
+    def _get_or_create_index(self, name: str, dimension: int):
+        """Récupérer un index Pinecone, en le créant s'il n'existe pas"""
+        existing_indexes = [index.name for index in self.pc.list_indexes()]
+        
+        if name not in existing_indexes:
+            # Vecteurs normalisés : le produit scalaire équivaut au cosinus
+            # sans calcul de normes
+            self.pc.create_index(
+                name=name,
+                dimension=dimension,
+                metric="dotproduct",
+                spec=ServerlessSpec(
+                    cloud="aws",
+                    region="us-east-1"
+                )
+            )
+            logger.info("Created Pinecone index: %s", name)
+        else:
+            description = self.pc.describe_index(name)
+            if description.dimension != dimension or description.metric != "dotproduct":
+                raise ValueError(
+                    f"L'index Pinecone {name} doit avoir {dimension} dimensions et la "
+                    f"métrique dotproduct"
+                )
+        
+        return self.pc.Index(name)
+    
     def _init_llm(self):
         """Initialiser le modèle LLM"""
         self.llm = ChatOpenAI(
@@ -85,7 +423,7 @@ class RAGPipeline:
             max_tokens=1000,
             openai_api_key=self.openai_api_key
         )
-        logger.info(f"LLM initialized: {self.config['model']}")
+        logger.info("LLM initialized: %s", self.config['model'])
     
     def _init_prompt(self):
         """Initialiser le prompt système"""
@@ -111,10 +449,14 @@ QUESTION DU CLIENT:
 
 RÉPONSE:"""
         
-        self.prompt_template = PromptTemplate(
-            template=self.system_prompt,
-            input_variables=["context", "question"]
-        )
+        # Découper le prompt une fois pour toutes : la construction par requête
+        # se réduit à une concaténation
+        self._prompt_prefix, rest = self.system_prompt.split("{context}")
+        self._prompt_mid, self._prompt_suffix = rest.split("{question}")
+    
+    def _build_prompt(self, context: str, question: str) -> str:
+        """Construire le prompt système pour une question"""
+        return self._prompt_prefix + context + self._prompt_mid + question + self._prompt_suffix
     
     async def query(self, question: str, session_id: Optional[str] = None) -> Dict[str, Any]:
         """
@@ -123,88 +465,348 @@ RÉPONSE:"""
         start_time = time.time()
         
         try:
-            # Recherche sémantique
-            docs_with_scores = await self.vectorstore.asimilarity_search_with_score(
-                question,
-                k=self.config["top_k"]
-            )
-            
-            # Filtrer par seuil de similarité
-            filtered_docs = []
-            for doc, score in docs_with_scores:
-                if score >= self.config["similarity_threshold"]:
-                    doc.metadata["score"] = score
-                    filtered_docs.append(doc)
-            
-            if not filtered_docs:
-                logger.warning(f"No relevant documents found for query: {question[:50]}...")
-                return {
-                    "response": "Je n'ai pas trouvé d'information pertinente dans ma base de connaissances. Je vous invite à contacter le service client au 0770 12 34 56.",
-                    "sources": [],
-                    "confidence": 0
-                }
+            # Recherche sur l'index réduit puis re-classement en pleine dimension
+            vector = (await self._embed_questions([question]))[0]
+            candidates = await self._search(truncate_embeddings(vector))
+            metadatas, scores = await self._rerank(vector, *candidates)
             
-            # Construire le contexte
-            context = "\n\n---\n\n".join([
-                f"[Source: {doc.metadata.get('filename', 'Inconnue')}]\n{doc.page_content}"
-                for doc in filtered_docs
-            ])
+            result = await self._answer(question, metadatas, scores)
             
-            # Générer la réponse avec le LLM
-            messages = [
-                ("system", self.system_prompt.format(context=context, question=question))
-            ]
+            processing_time = time.time() - start_time
             
-            response = await self.llm.ainvoke(messages)
+            logger.info(
+                "Query processed: question=%s confidence=%.3f sources=%d time=%.3fs",
+                question[:50], result["confidence"], len(result["sources"]), processing_time
+            )
             
-            # Calculer la confiance
-            avg_score = sum(doc.metadata.get("score", 0) for doc in filtered_docs) / len(filtered_docs)
+            return result
             
-            # Formater les sources
-            sources = [
-                {
-                    "document": doc.metadata.get("filename", "Inconnue"),
-                    "page": doc.metadata.get("page", 1),
-                    "score": round(doc.metadata.get("score", 0), 3)
-                }
-                for doc in filtered_docs
-            ]
+        except Exception as e:
+            logger.error("Error in query: %s", e)
+            raise
+    
+    async def query_batch(self, questions: List[str]) -> List[Dict[str, Any]]:
+        """
+        Interroger la base de connaissances pour plusieurs questions.
+        
+        Les questions sont vectorisées en un seul appel d'embeddings, puis les
+        recherches Pinecone et les appels LLM sont lancés en parallèle.
+        """
+        try:
+            vectors = await self._embed_questions(questions)
             
-            processing_time = time.time() - start_time
+            candidates = await asyncio.gather(*[
+                self._search(short) for short in truncate_embeddings(vectors)
+            ])
             
-            logger.info(f"Query processed", {
-                "question": question[:50],
-                "confidence": avg_score,
-                "sources_count": len(sources),
-                "processing_time": processing_time
-            })
+            reranked = await asyncio.gather(*[
+                self._rerank(vector, *found)
+                for vector, found in zip(vectors, candidates)
+            ])
             
-            return {
-                "response": response.content,
-                "sources": sources,
-                "confidence": round(avg_score, 3)
-            }
+            return await asyncio.gather(*[
+                self._answer(question, metadatas, scores)
+                for question, (metadatas, scores) in zip(questions, reranked)
+            ])
             
         except Exception as e:
-            logger.error(f"Error in query: {str(e)}")
+            logger.error("Error in batch query: %s", e)
             raise
     
-    async def index_document(self, chunks: List[Document], metadata: Dict[str, Any]):
+    async def _run(self, fn, *args, **kwargs):
+        """Exécuter un appel Pinecone bloquant sur le pool dédié"""
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self._pool, functools.partial(fn, *args, **kwargs))
+    
+    def close(self):
+        """
+        Libérer les ressources (pool de threads Pinecone).
+        
+        À appeler à l'arrêt de l'application (lifespan FastAPI) par le
+        service qui instancie le pipeline.
+        """
+        self._pool.shutdown(wait=False)
+    
+    async def _embed_questions(self, questions: List[str]) -> np.ndarray:
+        """
+        Vectoriser des questions en passant par le cache.
+        
+        Seules les questions absentes du cache sont envoyées à OpenAI, en un
+        seul appel d'embeddings.
+        """
+        keys = [
+            hashlib.blake2b(normalize_question(q).encode(), digest_size=16).hexdigest()
+            for q in questions
+        ]
+        vectors = [self._emb_cache.get(key) for key in keys]
+        
+        for key, vector in zip(keys, vectors):
+            if vector is not None:
+                self._emb_cache.move_to_end(key)
+        
+        missing = [i for i, vector in enumerate(vectors) if vector is None]
+        
+        if missing and self.redis is not None:
+            try:
+                cached = await self.redis.mget([f"rag:emb:{keys[i]}" for i in missing])
+                for i, raw in zip(missing, cached):
+                    if raw is not None:
+                        vectors[i] = np.frombuffer(raw, dtype=np.float32)
+                        self._cache_embedding(keys[i], vectors[i])
+                missing = [i for i in missing if vectors[i] is None]
+            except Exception as e:
+                logger.warning("Embedding cache unavailable: %s", e)
+        
+        if missing:
+            embedded = await self.embeddings.aembed_documents([questions[i] for i in missing])
+            
+            for i, values in zip(missing, normalize_embeddings(embedded)):
+                vectors[i] = values
+                self._cache_embedding(keys[i], vectors[i])
+            
+            if self.redis is not None:
+                try:
+                    async with self.redis.pipeline(transaction=False) as pipe:
+                        for i in missing:
+                            pipe.setex(f"rag:emb:{keys[i]}", EMBEDDING_CACHE_TTL, vectors[i].tobytes())
+                        await pipe.execute()
+                except Exception as e:
+                    logger.warning("Embedding cache unavailable: %s", e)
+        
+        return np.stack(vectors)
+    
+    def _cache_embedding(self, key: str, vector: np.ndarray):
+        """Ajouter un embedding au cache LRU en mémoire"""
+        self._emb_cache[key] = vector
+        self._emb_cache.move_to_end(key)
+        
+        if len(self._emb_cache) > EMBEDDING_CACHE_SIZE:
+            self._emb_cache.popitem(last=False)
+    
+    async def _search(self, vector: np.ndarray):
+        """
+        Rechercher les RERANK_CANDIDATES plus proches voisins sur l'index réduit.
+        
+        Les namespaces sont interrogés en parallèle et leurs résultats
+        fusionnés par score.
+        
+        Returns:
+            Tuple (ids, métadonnées, vecteurs pleine dimension). Les vecteurs ne
+            sont disponibles qu'avec l'index local, sinon None.
+        """
+        k = max(RERANK_CANDIDATES, self.config["top_k"])
+        
+        await self._sync_local_index()
+        
+        if self.local_index is not None:
+            return self.local_index.search(vector, k)
+        
+        values = vector.tolist()
+        responses = await asyncio.gather(*[
+            self._run(
+                self.index.query,
+                vector=values,
+                top_k=k,
+                namespace=namespace,
+                include_metadata=True
+            )
+            for namespace in self.namespaces
+        ])
+        
+        matches = sorted(
+            (m for response in responses for m in response.matches),
+            key=lambda m: m.score,
+            reverse=True
+        )[:k]
+        
+        return [m.id for m in matches], [m.metadata for m in matches], None
+    
+    async def _rerank(self, vector: np.ndarray, ids: List[str],
+                      metadatas: List[Dict[str, Any]], full: Optional[np.ndarray] = None):
+        """
+        Re-classer les candidats ANN par similarité cosinus en pleine dimension.
+        
+        Les vecteurs des candidats sont empilés dans une matrice contiguë et
+        tous les scores sont calculés en une seule opération BLAS.
+        
+        Returns:
+            Tuple (métadonnées, scores) des top_k meilleurs candidats
+        """
+        if not ids:
+            return [], np.empty(0, dtype=np.float32)
+        
+        if full is None:
+            fetched = await self._run(self.full_index.fetch, ids=ids, namespace=FULL_NAMESPACE)
+            kept = [i for i, vector_id in enumerate(ids) if vector_id in fetched.vectors]
+            metadatas = [metadatas[i] for i in kept]
+            full = np.asarray([fetched.vectors[ids[i]].values for i in kept], dtype=np.float32)
+        
+        # Les embeddings sont normalisés : la similarité cosinus se réduit à
+        # un produit matrice-vecteur (k, d) @ (d,)
+        scores = np.ascontiguousarray(full, dtype=np.float32) @ vector
+        order = np.argsort(-scores)[:self.config["top_k"]]
+        
+        return [metadatas[i] for i in order], scores[order]
+    
+    def _build_context(self, metadatas: List[Dict[str, Any]],
+                       scores: np.ndarray) -> Optional[Tuple[str, List[Dict[str, Any]], float]]:
+        """
+        Filtrer les chunks par seuil de similarité et construire le contexte.
+        
+        Returns:
+            Tuple (contexte, sources, score moyen), ou None si aucun chunk n'est pertinent
+        """
+        mask = scores >= self.config["similarity_threshold"]
+        
+        if not mask.any():
+            return None
+        
+        kept_idx = np.nonzero(mask)[0]
+        relevant = [metadatas[i] for i in kept_idx]
+        kept_scores = scores[kept_idx]
+        
+        context = "\n\n---\n\n".join([
+            f"[Source: {metadata.get('filename', 'Inconnue')}]\n{metadata.get('text', '')}"
+            for metadata in relevant
+        ])
+        
+        sources = [
+            {
+                "document": metadata.get("filename", "Inconnue"),
+                "page": metadata.get("page", 1),
+                "score": score
+            }
+            for metadata, score in zip(relevant, np.round(kept_scores, 3).tolist())
+        ]
+        
+        return context, sources, float(kept_scores.mean())
+    
+    async def _answer(self, question: str, metadatas: List[Dict[str, Any]],
+                      scores: np.ndarray) -> Dict[str, Any]:
+        """
+        Générer la réponse à partir des chunks retrouvés et de leurs scores
+        """
+        built = self._build_context(metadatas, scores)
+        
+        if built is None:
+            logger.warning("No relevant documents found for query: %s...", question[:50])
+            return {
+                "response": NO_ANSWER_MESSAGE,
+                "sources": [],
+                "confidence": 0
+            }
+        
+        context, sources, avg_score = built
+        
+        messages = [
+            ("system", self._build_prompt(context, question))
+        ]
+        
+        response = await self.llm.ainvoke(messages)
+        
+        return {
+            "response": response.content,
+            "sources": sources,
+            "confidence": round(avg_score, 3)
+        }
+    
+    async def stream_query(self, question: str) -> AsyncIterator[Dict[str, Any]]:
         """
-        Indexer un document dans Pinecone
+        Interroger le RAG en diffusant la réponse au fil de sa génération.
+        
+        La recherche et le re-classement sont faits avant le début du flux :
+        le premier événement contient les sources, les suivants les fragments
+        de la réponse.
+        """
+        vector = (await self._embed_questions([question]))[0]
+        candidates = await self._search(truncate_embeddings(vector))
+        metadatas, scores = await self._rerank(vector, *candidates)
+        
+        built = self._build_context(metadatas, scores)
+        
+        if built is None:
+            logger.warning("No relevant documents found for query: %s...", question[:50])
+            yield {"type": "sources", "sources": [], "confidence": 0}
+            yield {"type": "token", "content": NO_ANSWER_MESSAGE}
+            return
+        
+        context, sources, avg_score = built
+        
+        yield {"type": "sources", "sources": sources, "confidence": round(avg_score, 3)}
+        
+        messages = [
+            ("system", self._build_prompt(context, question))
+        ]
+        
+        async for chunk in self.llm.astream(messages):
+            if chunk.content:
+                yield {"type": "token", "content": chunk.content}
+    
+    async def index_document(self, chunks: List[Document], metadata: Dict[str, Any],
+                             namespace: Optional[str] = None):
+        """
+        Indexer un document dans Pinecone.
+        
+        Les embeddings de tous les chunks sont générés en un seul appel OpenAI,
+        puis les vecteurs sont envoyés à Pinecone par lots de UPSERT_BATCH_SIZE
+        en parallèle.
+        
+        Args:
+            chunks: Chunks du document
+            metadata: Métadonnées communes à tous les chunks
+            namespace: Namespace (catégorie) cible, le premier configuré par défaut
         """
         try:
-            # Ajouter les métadonnées à chaque chunk
-            for chunk in chunks:
-                chunk.metadata.update(metadata)
+            if not chunks:
+                return []
+            
+            namespace = namespace or self.namespaces[0]
+            if namespace not in self.namespaces:
+                raise ValueError(f"Namespace inconnu: {namespace}")
             
-            # Indexer dans Pinecone
-            await self.vectorstore.aadd_documents(chunks)
+            doc_id = metadata.get("doc_id")
             
-            logger.info(f"Indexed {len(chunks)} chunks for document {metadata.get('doc_id')}")
+            # Les IDs sont préfixés par le doc_id pour pouvoir retrouver
+            # (et supprimer) les vecteurs d'un document via index.list(prefix=...)
+            ids = [f"{doc_id}#{uuid.uuid4()}" for _ in chunks]
+            texts = [chunk.page_content for chunk in chunks]
+            metadatas = [
+                {**chunk.metadata, **metadata, "text": chunk.page_content}
+                for chunk in chunks
+            ]
+            
+            # Un seul appel d'embeddings pour tout le document
+            vectors = normalize_embeddings(await self.embeddings.aembed_documents(texts))
+            short_vectors = truncate_embeddings(vectors).tolist()
+            
+            # Index de recherche (réduit, avec métadonnées) et index pleine
+            # dimension (vecteurs seuls, pour le re-classement)
+            records = list(zip(ids, short_vectors, metadatas))
+            full_records = list(zip(ids, vectors.tolist()))
+            batches = [
+                (self.index, namespace, records[i:i + UPSERT_BATCH_SIZE])
+                for i in range(0, len(records), UPSERT_BATCH_SIZE)
+            ] + [
+                (self.full_index, FULL_NAMESPACE, full_records[i:i + UPSERT_BATCH_SIZE])
+                for i in range(0, len(full_records), UPSERT_BATCH_SIZE)
+            ]
+            
+            if self.local_index is not None:
+                self.local_index.add(ids, short_vectors, vectors, metadatas)
+            
+            await asyncio.gather(*[
+                self._run(index.upsert, vectors=batch, namespace=target)
+                for index, target, batch in batches
+            ])
+            
+            await self._bump_local_index_version()
+            
+            logger.info("Indexed %s chunks for document %s in %s batches", len(chunks), doc_id, len(batches))
+            
+            return ids
             
         except Exception as e:
-            logger.error(f"Error indexing document: {str(e)}")
+            logger.error("Error indexing document: %s", e)
             raise
     
     async def delete_document(self, doc_id: str):
@@ -212,17 +814,36 @@ RÉPONSE:"""
         Supprimer un document et ses vecteurs
         """
         try:
-            # Récupérer tous les vecteurs avec ce doc_id
-            # Note: Pinecone ne supporte pas directement la suppression par métadonnées
-            # Il faut d'abord rechercher puis supprimer
+            if self.local_index is not None:
+                self.local_index.remove_document(doc_id)
+            
+            # Les vecteurs d'un document partagent le préfixe "{doc_id}#"
+            pages = await asyncio.gather(*[
+                self._run(
+                    lambda ns=namespace: list(self.index.list(prefix=f"{doc_id}#", namespace=ns))
+                )
+                for namespace in self.namespaces
+            ])
+            
+            deleted = 0
+            for namespace, namespace_pages in zip(self.namespaces, pages):
+                vector_ids = [vector_id for page in namespace_pages for vector_id in page]
+                
+                for i in range(0, len(vector_ids), UPSERT_BATCH_SIZE):
+                    batch = vector_ids[i:i + UPSERT_BATCH_SIZE]
+                    await asyncio.gather(
+                        self._run(self.index.delete, ids=batch, namespace=namespace),
+                        self._run(self.full_index.delete, ids=batch, namespace=FULL_NAMESPACE)
+                    )
+                
+                deleted += len(vector_ids)
             
-            # Pour l'instant, on supprime par namespace
-            # Une implémentation plus robuste nécessiterait de stocker les IDs
+            await self._bump_local_index_version()
             
-            logger.info(f"Document deletion requested for {doc_id}")
+            logger.info("Deleted %s vectors for document %s", deleted, doc_id)
             
         except Exception as e:
-            logger.error(f"Error deleting document: {str(e)}")
+            logger.error("Error deleting document: %s", e)
             raise
     
     async def list_documents(self) -> List[Dict[str, Any]]:
@@ -231,7 +852,7 @@ RÉPONSE:"""
         """
         try:
             # Récupérer les statistiques de l'index
-            stats = self.index.describe_index_stats()
+            stats = await self._run(self.index.describe_index_stats)
             
             # Note: Pinecone ne permet pas de lister directement les documents
             # Il faudrait stocker cette information dans une base de données
@@ -239,7 +860,7 @@ RÉPONSE:"""
             return []
             
         except Exception as e:
-            logger.error(f"Error listing documents: {str(e)}")
+            logger.error("Error listing documents: %s", e)
             raise
     
     def update_config(self, new_config: Dict[str, Any]):
@@ -252,7 +873,7 @@ RÉPONSE:"""
         if "model" in new_config:
             self._init_llm()
         
-        logger.info("Configuration updated", self.config)
+        logger.info("Configuration updated: %s", self.config)
     
     def get_config(self) -> Dict[str, Any]:
         """
@@ -265,7 +886,7 @@ RÉPONSE:"""
         Récupérer les statistiques
         """
         try:
-            stats = self.index.describe_index_stats()
+            stats = await self._run(self.index.describe_index_stats)
             
             return {
                 "total_vectors": stats.total_vector_count,
@@ -278,5 +899,5 @@ RÉPONSE:"""
             }
             
         except Exception as e:
-            logger.error(f"Error getting stats: {str(e)}")
+            logger.error("Error getting stats: %s", e)
             raise
@@ -1,15 +1,131 @@
 import os
+import time
 import uuid
-from typing import List, Dict, Any, Optional
+import random
+import hashlib
+import asyncio
+import functools
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from typing import List, Dict, Any, Optional, AsyncIterator, Tuple
 from datetime import datetime
 
+import httpx
+import orjson
 import openai
+import asyncpg
+from pgvector.asyncpg import register_vector
 from supabase import create_client, Client
 from langchain.schema import Document
-from langchain.text_splitter import RecursiveCharacterTextSplitter
 
+from services.document_processor import get_text_splitter
 from utils.logger import logger
 
+# Threads dédiés aux appels bloquants (client Supabase synchrone)
+BLOCKING_POOL_SIZE = 64
+
+# Dimension de la colonne knowledge_chunks.embedding et du paramètre de
+# match_knowledge_chunks (halfvec(1024)) : en changer impose une migration
+EMBEDDING_COLUMN_DIMENSIONS = 1024
+
+# Nombre de textes envoyés par appel à l'API embeddings d'OpenAI
+EMBEDDING_BATCH_SIZE = 256
+# Nombre maximum d'appels embeddings simultanés
+EMBEDDING_CONCURRENCY = 5
+
+# Insertion des chunks : lignes par requête et requêtes simultanées
+CHUNK_INSERT_BATCH_SIZE = int(os.getenv("CHUNK_INSERT_BATCH_SIZE", "500"))
+CHUNK_INSERT_CONCURRENCY = 4
+
+# Lots de chunks vectorisés en attente d'insertion pendant l'indexation
+INDEXING_QUEUE_SIZE = 4
+
+# Connexions HTTP persistantes (keep-alive) vers OpenAI et PostgREST
+HTTP_POOL_LIMITS = httpx.Limits(max_keepalive_connections=50, max_connections=100)
+
+# Cache des embeddings de requêtes : nombre d'entrées et durée de vie (s)
+QUERY_EMBEDDING_CACHE_SIZE = 1024
+QUERY_EMBEDDING_CACHE_TTL = 3600
+
+# Cache des réponses générées : nombre d'entrées et durée de vie (s)
+ANSWER_CACHE_SIZE = 1024
+ANSWER_CACHE_TTL = 3600
+
+# Paramètres de construction de l'index idx_knowledge_chunks_embedding_hnsw
+# (fixés dans les scripts SQL, reportés tels quels dans les statistiques)
+HNSW_M = 24
+HNSW_EF_CONSTRUCTION = 128
+
+# ef_search selon la taille du corpus : (nombre max de vecteurs, ef_search).
+# Plus le graphe est grand, plus la liste de candidats doit l'être pour
+# conserver le rappel.
+HNSW_TIERS = [
+    (50_000, 64),
+    (1_000_000, 100),
+    (float("inf"), 200),
+]
+
+
+# Valeur sentinelle pour comparer des métadonnées sans ambiguïté avec None
+_MISSING = object()
+
+
+def _check_embedding_dimensions(dimensions: int):
+    """Vérifier que la dimension des embeddings correspond au schéma"""
+    if dimensions != EMBEDDING_COLUMN_DIMENSIONS:
+        raise ValueError(
+            f"EMBEDDING_DIMENSIONS={dimensions} ne correspond pas à la colonne "
+            f"knowledge_chunks.embedding (halfvec({EMBEDDING_COLUMN_DIMENSIONS})) : "
+            f"changer de dimension nécessite une migration"
+        )
+
+
+def _cache_get(cache: OrderedDict, key, ttl: float):
+    """Lire une entrée non expirée d'un cache LRU (None si absente)"""
+    entry = cache.get(key)
+    if entry is None or time.monotonic() - entry[0] >= ttl:
+        return None
+    cache.move_to_end(key)
+    return entry[1]
+
+
+def _cache_put(cache: OrderedDict, key, value, max_size: int):
+    """Ajouter une entrée à un cache LRU en évinçant la plus ancienne"""
+    cache[key] = (time.monotonic(), value)
+    cache.move_to_end(key)
+    if len(cache) > max_size:
+        cache.popitem(last=False)
+
+
+NO_ANSWER_MESSAGE = "Je n'ai pas trouvé d'information pertinente dans ma base de connaissances. Je vous invite à contacter le service client au 0770 12 34 56."
+
+SYSTEM_PROMPT = """Tu es Aimé, l'assistant virtuel intelligent de la CNSS.
+
+CONTEXTE:
+Tu assistes les assurés de la CNSS pour leurs questions sur les prestations sociales.
+
+RÈGLES STRICTES:
+1. Réponds UNIQUEMENT en français
+2. Base-toi UNIQUEMENT sur le contexte fourni ci-dessous
+3. Si l'information n'est pas dans le contexte, dis "Je n'ai pas trouvé cette information"
+4. Sois professionnel, chaleureux et concis
+5. Ne partage JAMAIS d'informations sensibles
+6. Cite toujours tes sources
+
+CONTEXTE DOCUMENTAIRE:
+{context}
+
+QUESTION DU CLIENT:
+{question}
+
+RÉPONSE:"""
+
+# Prompt découpé une fois pour toutes : la construction par requête se réduit
+# à une concaténation
+SYSTEM_PROMPT_PREFIX, _rest = SYSTEM_PROMPT.split("{context}")
+SYSTEM_PROMPT_MID, SYSTEM_PROMPT_SUFFIX = _rest.split("{question}")
+del _rest
+
 
 class SupabaseRAGService:
     """
@@ -19,18 +135,51 @@ class SupabaseRAGService:
     def __init__(self):
         self.supabase_url = os.getenv("SUPABASE_URL")
         self.supabase_key = os.getenv("SUPABASE_SERVICE_KEY")
+        # Connexion Postgres directe (optionnelle) pour l'insertion des chunks
+        self.supabase_db_url = os.getenv("SUPABASE_DB_URL")
         self.openai_api_key = os.getenv("OPENAI_API_KEY")
         
         # Configuration RAG
         self.config = {
             "model": os.getenv("OPENAI_MODEL", "gpt-4"),
             "embedding_model": "text-embedding-3-large",
+            "embedding_dimensions": int(os.getenv("EMBEDDING_DIMENSIONS", "1024")),
             "chunk_size": int(os.getenv("CHUNK_SIZE", "1000")),
             "chunk_overlap": int(os.getenv("CHUNK_OVERLAP", "200")),
             "top_k": int(os.getenv("TOP_K", "5")),
-            "similarity_threshold": float(os.getenv("SIMILARITY_THRESHOLD", "0.75"))
+            "similarity_threshold": float(os.getenv("SIMILARITY_THRESHOLD", "0.75")),
+            "hnsw_ef_search": int(os.getenv("HNSW_EF_SEARCH", "100")),
+            # ef_search ajusté à la taille du corpus, sauf si fixé par HNSW_EF_SEARCH
+            "hnsw_auto_tune": "HNSW_EF_SEARCH" not in os.environ
+        }
+        _check_embedding_dimensions(self.config["embedding_dimensions"])
+        
+        # Pool dédié aux appels bloquants, distinct de l'exécuteur par défaut
+        # utilisé par FastAPI (fichiers uploadés, etc.)
+        self._pool = ThreadPoolExecutor(
+            max_workers=BLOCKING_POOL_SIZE,
+            thread_name_prefix="rag-io"
+        )
+        
+        # Paramètres HNSW courants, ajustés par refresh_hnsw_params
+        self.hnsw_params = {
+            "m": HNSW_M,
+            "ef_construction": HNSW_EF_CONSTRUCTION,
+            "ef_search": self.config["hnsw_ef_search"]
         }
         
+        # Limite les lots d'embeddings envoyés en parallèle à OpenAI
+        self._embed_sem = asyncio.Semaphore(EMBEDDING_CONCURRENCY)
+        
+        # Cache LRU des embeddings de requêtes : clé -> (horodatage, embedding)
+        self._query_embedding_cache: OrderedDict = OrderedDict()
+        self._query_embedding_lock = asyncio.Lock()
+        
+        # Cache des réponses : clé -> (horodatage, réponse). La génération est
+        # incluse dans la clé et incrémentée à chaque suppression de document.
+        self._answer_cache: OrderedDict = OrderedDict()
+        self._answer_cache_generation = 0
+        
         # Initialiser les clients
         self._init_supabase()
         self._init_openai()
@@ -45,21 +194,44 @@ class SupabaseRAGService:
             raise ValueError("SUPABASE_URL et SUPABASE_SERVICE_KEY sont requis")
         
         self.supabase: Client = create_client(self.supabase_url, self.supabase_key)
+        
+        # Client REST asynchrone pour les écritures volumineuses (chunks)
+        self.rest_client = httpx.AsyncClient(
+            base_url=f"{self.supabase_url}/rest/v1",
+            headers={
+                "apikey": self.supabase_key,
+                "Authorization": f"Bearer {self.supabase_key}",
+                "Prefer": "return=minimal",
+                "Content-Type": "application/json"
+            },
+            timeout=60,
+            limits=HTTP_POOL_LIMITS
+        )
+        self._insert_sem = asyncio.Semaphore(CHUNK_INSERT_CONCURRENCY)
+        
+        # Pool asyncpg créé à la première insertion (nécessite une boucle active)
+        self._db_pool: Optional[asyncpg.Pool] = None
+        self._db_pool_lock = asyncio.Lock()
+        
         logger.info("Supabase client initialized")
     
     def _init_openai(self):
         """Initialiser le client OpenAI"""
         openai.api_key = self.openai_api_key
-        self.openai_client = openai.OpenAI(api_key=self.openai_api_key)
+        
+        # Client HTTP/2 partagé : les connexions TLS sont réutilisées d'un appel à l'autre
+        self.openai_http_client = httpx.AsyncClient(http2=True, timeout=60, limits=HTTP_POOL_LIMITS)
+        self.openai_client = openai.AsyncOpenAI(
+            api_key=self.openai_api_key,
+            http_client=self.openai_http_client
+        )
         logger.info("OpenAI client initialized")
     
     def _init_text_splitter(self):
         """Initialiser le splitter de texte"""
-        self.text_splitter = RecursiveCharacterTextSplitter(
-            chunk_size=self.config["chunk_size"],
-            chunk_overlap=self.config["chunk_overlap"],
-            length_function=len,
-            separators=["\n\n", "\n", ". ", " ", ""]
+        self.text_splitter = get_text_splitter(
+            self.config["chunk_size"],
+            self.config["chunk_overlap"]
         )
     
     def _init_database(self):
@@ -68,23 +240,125 @@ class SupabaseRAGService:
             # Activer l'extension pgvector
             self.supabase.rpc('enable_pgvector').execute()
         except Exception as e:
-            logger.warning(f"pgvector may already be enabled: {e}")
+            logger.warning("pgvector may already be enabled: %s", e)
         
         logger.info("Database initialized")
     
+    async def _run(self, fn, *args, **kwargs):
+        """
+        Exécuter un appel bloquant sur le pool dédié.
+        
+        Toutes les requêtes du client Supabase (synchrone) passent par ici,
+        typiquement sous la forme self._run(requete.execute).
+        """
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self._pool, functools.partial(fn, *args, **kwargs))
+    
+    async def close(self):
+        """Libérer les ressources (connexions Postgres, clients HTTP, pool de threads)"""
+        if self._db_pool is not None:
+            await self._db_pool.close()
+        await self.openai_http_client.aclose()
+        await self.rest_client.aclose()
+        self._pool.shutdown(wait=False)
+    
+    async def _get_db_pool(self) -> asyncpg.Pool:
+        """Pool de connexions Postgres directes, créé à la demande"""
+        async with self._db_pool_lock:
+            if self._db_pool is None:
+                self._db_pool = await asyncpg.create_pool(
+                    self.supabase_db_url,
+                    min_size=1,
+                    max_size=CHUNK_INSERT_CONCURRENCY,
+                    # Compatible avec le pooler Supabase (pgbouncer en mode transaction)
+                    statement_cache_size=0,
+                    init=register_vector
+                )
+                logger.info("Postgres connection pool initialized")
+        return self._db_pool
+    
+    async def _copy_chunks(self, chunk_records: List[Dict[str, Any]]):
+        """
+        Insérer les chunks avec COPY (protocole binaire) via asyncpg.
+        
+        Les embeddings sont transmis en binaire au lieu d'être sérialisés en
+        JSON puis analysés par PostgREST.
+        """
+        pool = await self._get_db_pool()
+        async with pool.acquire() as conn:
+            await conn.copy_records_to_table(
+                "knowledge_chunks",
+                columns=["document_id", "content", "embedding", "metadata"],
+                records=[
+                    (r["document_id"], r["content"], r["embedding"], orjson.dumps(r["metadata"]).decode())
+                    for r in chunk_records
+                ]
+            )
+    
+    async def _store_chunks(self, chunk_records: List[Dict[str, Any]]):
+        """Insérer des chunks, par COPY si la connexion directe est configurée"""
+        if self.supabase_db_url:
+            await self._copy_chunks(chunk_records)
+            return
+        
+        # Sinon par lots, en parallèle, via PostgREST
+        batch_size = CHUNK_INSERT_BATCH_SIZE
+        await asyncio.gather(*[
+            self._insert_chunks_batch(chunk_records[i:i + batch_size])
+            for i in range(0, len(chunk_records), batch_size)
+        ])
+    
+    async def _insert_chunks_batch(self, batch: List[Dict[str, Any]]):
+        """Insérer un lot de chunks via l'API REST de Supabase"""
+        # orjson sérialise les tableaux de floats des embeddings bien plus vite que json
+        body = orjson.dumps(batch)
+        async with self._insert_sem:
+            response = await self.rest_client.post("/knowledge_chunks", content=body)
+        response.raise_for_status()
+    
     async def generate_embedding(self, text: str) -> List[float]:
         """Générer un embedding avec OpenAI"""
         try:
-            response = self.openai_client.embeddings.create(
+            response = await self.openai_client.embeddings.create(
                 model=self.config["embedding_model"],
+                dimensions=self.config["embedding_dimensions"],
                 input=text
             )
             return response.data[0].embedding
         except Exception as e:
-            logger.error(f"Error generating embedding: {e}")
+            logger.error("Error generating embedding: %s", e)
             raise
     
-    async def index_document(self, doc_id: str, filename: str, content: str, 
+    async def generate_embeddings_batch(self, texts: List[str],
+                                        batch_size: int = EMBEDDING_BATCH_SIZE) -> List[List[float]]:
+        """
+        Générer les embeddings d'une liste de textes, par lots de batch_size
+        textes par appel OpenAI.
+        
+        Les lots sont envoyés en parallèle, au plus EMBEDDING_CONCURRENCY à la
+        fois.
+        
+        Returns:
+            Embeddings dans l'ordre des textes
+        """
+        async def embed_batch(batch: List[str]) -> List[List[float]]:
+            async with self._embed_sem:
+                # Étaler les requêtes pour éviter les rafales de 429
+                await asyncio.sleep(random.uniform(0, 0.05))
+                response = await self.openai_client.embeddings.create(
+                    model=self.config["embedding_model"],
+                    dimensions=self.config["embedding_dimensions"],
+                    input=batch
+                )
+            return [d.embedding for d in sorted(response.data, key=lambda d: d.index)]
+        
+        results = await asyncio.gather(*(
+            embed_batch(texts[i:i + batch_size])
+            for i in range(0, len(texts), batch_size)
+        ))
+        return [embedding for batch in results for embedding in batch]
+    
+    async def index_document(self, doc_id: str, filename: str, size: int, 
                             doc_type: str, chunks: List[Document]) -> Dict[str, Any]:
         """
         Indexer un document dans Supabase.
@@ -92,59 +366,143 @@ class SupabaseRAGService:
         Args:
             doc_id: ID unique du document
             filename: Nom du fichier
-            content: Contenu brut du document
-            doc_type: Type de document (pdf, docx, etc.)
+            size: Taille du fichier en octets
+            doc_type: Type de document (extension avec le point : .pdf, .docx, etc.)
             chunks: Liste des chunks LangChain
         """
         try:
+            # Métadonnées communes (fichier source, etc.) stockées une seule
+            # fois sur le document, fusionnées à la recherche : seules les
+            # paires clé/valeur identiques sur tous les chunks, pour que la
+            # fusion n'ajoute rien à un chunk qui ne les portait pas
+            doc_metadata = {
+                key: value for key, value in (chunks[0].metadata if chunks else {}).items()
+                if key != "page" and all(
+                    chunk.metadata.get(key, _MISSING) == value for chunk in chunks[1:]
+                )
+            }
+            
             # 1. Insérer le document dans knowledge_documents
             doc_data = {
                 "id": doc_id,
                 "name": filename,
                 "type": doc_type,
-                "size": len(content),
+                "size": size,
                 "status": "INDEXING",
                 "chunks": len(chunks),
+                "metadata": doc_metadata,
                 "created_at": datetime.utcnow().isoformat()
             }
             
-            self.supabase.table("knowledge_documents").insert(doc_data).execute()
-            logger.info(f"Document {doc_id} inserted into knowledge_documents")
+            await self._run(self.supabase.table("knowledge_documents").insert(doc_data).execute)
+            logger.info("Document %s inserted into knowledge_documents", doc_id)
+            
+            # 2. Générer les embeddings et insérer les chunks en pipeline :
+            # chaque lot d'EMBEDDING_BATCH_SIZE chunks est mis en file dès
+            # que ses embeddings sont prêts, l'insertion commence donc après
+            # le premier appel OpenAI
+            queue: asyncio.Queue = asyncio.Queue(maxsize=INDEXING_QUEUE_SIZE)
+            # Lots embeddés mais pas encore en file : borne la mémoire quand
+            # l'insertion est plus lente que les embeddings
+            producer_slots = asyncio.Semaphore(EMBEDDING_CONCURRENCY)
+            
+            async def produce_batch(offset: int):
+                batch = chunks[offset:offset + EMBEDDING_BATCH_SIZE]
+                async with producer_slots:
+                    # Un seul lot : un appel OpenAI soumis à _embed_sem
+                    embeddings = await self.generate_embeddings_batch([c.page_content for c in batch])
+                    
+                    chunk_records = []
+                    for i, (chunk, embedding) in enumerate(zip(batch, embeddings), offset):
+                        # id et created_at sont laissés aux valeurs par défaut de
+                        # la table (gen_random_uuid(), CURRENT_TIMESTAMP)
+                        chunk_record = {
+                            "document_id": doc_id,
+                            "content": chunk.page_content,
+                            "embedding": embedding,
+                            "metadata": {
+                                "page": chunk.metadata.get("page", 1),
+                                "chunk_index": i,
+                                # Seules les valeurs propres au chunk
+                                **{
+                                    key: value for key, value in chunk.metadata.items()
+                                    if key != "page" and doc_metadata.get(key, _MISSING) != value
+                                }
+                            }
+                        }
+                        chunk_records.append(chunk_record)
+                    
+                    await queue.put(chunk_records)
             
-            # 2. Générer les embeddings et insérer les chunks
-            chunk_records = []
-            for i, chunk in enumerate(chunks):
-                # Générer l'embedding
-                embedding = await self.generate_embedding(chunk.page_content)
+            async def produce():
+                # Les lots arrivent dans l'ordre de fin des appels, chunk_index
+                # conserve la position de chaque chunk dans le document
+                batch_tasks = [
+                    asyncio.create_task(produce_batch(offset))
+                    for offset in range(0, len(chunks), EMBEDDING_BATCH_SIZE)
+                ]
+                try:
+                    await asyncio.gather(*batch_tasks)
+                except BaseException:
+                    for task in batch_tasks:
+                        task.cancel()
+                    raise
+                await queue.put(None)
+            
+            async def consume():
+                # Les lots d'embeddings sont regroupés en lots d'insertion de
+                # CHUNK_INSERT_BATCH_SIZE lignes, insérés en parallèle ; la file
+                # n'est plus lue tant que CHUNK_INSERT_CONCURRENCY insertions
+                # sont en cours
+                insert_slots = asyncio.Semaphore(CHUNK_INSERT_CONCURRENCY)
+                inserts = []
+                
+                async def store(records: List[Dict[str, Any]]):
+                    try:
+                        await self._store_chunks(records)
+                    finally:
+                        insert_slots.release()
+                
+                async def flush(records: List[Dict[str, Any]]):
+                    await insert_slots.acquire()
+                    # Arrêter au plus tôt si une insertion a échoué
+                    for task in inserts:
+                        if task.done() and not task.cancelled() and task.exception():
+                            insert_slots.release()
+                            raise task.exception()
+                    inserts.append(asyncio.create_task(store(records)))
                 
-                chunk_record = {
-                    "id": str(uuid.uuid4()),
-                    "document_id": doc_id,
-                    "content": chunk.page_content,
-                    "embedding": embedding,
-                    "metadata": {
-                        "page": chunk.metadata.get("page", 1),
-                        "chunk_index": i,
-                        **chunk.metadata
-                    },
-                    "created_at": datetime.utcnow().isoformat()
-                }
-                chunk_records.append(chunk_record)
+                pending = []
+                try:
+                    while (chunk_records := await queue.get()) is not None:
+                        pending.extend(chunk_records)
+                        while len(pending) >= CHUNK_INSERT_BATCH_SIZE:
+                            await flush(pending[:CHUNK_INSERT_BATCH_SIZE])
+                            pending = pending[CHUNK_INSERT_BATCH_SIZE:]
+                    if pending:
+                        await flush(pending)
+                    await asyncio.gather(*inserts)
+                except BaseException:
+                    for task in inserts:
+                        task.cancel()
+                    raise
             
-            # Insérer les chunks par batch de 100
-            batch_size = 100
-            for i in range(0, len(chunk_records), batch_size):
-                batch = chunk_records[i:i + batch_size]
-                self.supabase.table("knowledge_chunks").insert(batch).execute()
-                logger.info(f"Inserted batch {i//batch_size + 1} of chunks for document {doc_id}")
+            tasks = [asyncio.create_task(produce()), asyncio.create_task(consume())]
+            try:
+                await asyncio.gather(*tasks)
+            except Exception:
+                # Une étape en échec ne doit pas laisser l'autre bloquée sur la file
+                for task in tasks:
+                    task.cancel()
+                raise
+            logger.info("Inserted %s chunks for document %s", len(chunks), doc_id)
             
             # 3. Mettre à jour le statut du document
-            self.supabase.table("knowledge_documents").update({
-                "status": "INDEXED",
-                "indexed_at": datetime.utcnow().isoformat()
-            }).eq("id", doc_id).execute()
+            await self._run(self.supabase.rpc('finalize_document', {'doc_id': doc_id}).execute)
+            
+            logger.info("Document %s indexed successfully with %s chunks", doc_id, len(chunks))
             
-            logger.info(f"Document {doc_id} indexed successfully with {len(chunks)} chunks")
+            await self.refresh_hnsw_params()
             
             return {
                 "success": True,
@@ -153,23 +511,26 @@ class SupabaseRAGService:
             }
             
         except Exception as e:
-            logger.error(f"Error indexing document {doc_id}: {e}")
+            logger.error("Error indexing document %s: %s", doc_id, e)
             # Mettre à jour le statut en erreur
             try:
-                self.supabase.table("knowledge_documents").update({
+                await self._run(self.supabase.table("knowledge_documents").update({
                     "status": "FAILED"
-                }).eq("id", doc_id).execute()
+                }).eq("id", doc_id).execute)
             except:
                 pass
             raise
     
-    async def search_similar(self, query: str, top_k: int = None) -> List[Dict[str, Any]]:
+    async def search_similar(self, query: str, top_k: int = None,
+                             filters: Optional[Dict[str, Any]] = None) -> List[Dict[str, Any]]:
         """
         Rechercher les chunks similaires à une requête.
         
         Args:
             query: Texte de la requête
             top_k: Nombre de résultats (défaut: config.top_k)
+            filters: Filtres optionnels {"doc_type": str, "doc_ids": List[str]},
+                doc_type étant l'extension du fichier, point inclus (ex: ".pdf")
         
         Returns:
             Liste des chunks similaires avec leur score
@@ -177,30 +538,156 @@ class SupabaseRAGService:
         try:
             top_k = top_k or self.config["top_k"]
             
-            # Générer l'embedding de la requête
-            query_embedding = await self.generate_embedding(query)
-            
-            # Recherche par similarité cosinus
-            # Supabase avec pgvector supporte l'opérateur <=> pour la distance
-            response = self.supabase.rpc(
-                'match_knowledge_chunks',
-                {
-                    'query_embedding': query_embedding,
-                    'match_threshold': self.config["similarity_threshold"],
-                    'match_count': top_k
-                }
-            ).execute()
+            # Générer l'embedding de la requête (ou le reprendre du cache)
+            query_embedding = await self._get_query_embedding(query)
             
-            results = response.data if response.data else []
+            results = await self._run(self._match_chunks, query_embedding, top_k, filters)
             
-            logger.info(f"Search for '{query[:50]}...' returned {len(results)} results")
+            logger.info("Search for '%s...' returned %s results", query[:50], len(results))
             
             return results
             
         except Exception as e:
-            logger.error(f"Error searching similar chunks: {e}")
+            logger.error("Error searching similar chunks: %s", e)
             raise
     
+    async def _get_query_embedding(self, query: str) -> List[float]:
+        """Embedding d'une requête, servi depuis le cache LRU si disponible"""
+        return (await self._get_query_embeddings([query]))[0]
+    
+    async def _get_query_embeddings(self, queries: List[str]) -> List[List[float]]:
+        """
+        Embeddings de plusieurs requêtes via le cache LRU.
+        
+        Seules les requêtes absentes du cache sont envoyées à OpenAI, en un
+        seul appel d'embeddings.
+        """
+        keys = [hashlib.blake2b(query.encode(), digest_size=16).digest() for query in queries]
+        
+        async with self._query_embedding_lock:
+            embeddings = [
+                _cache_get(self._query_embedding_cache, key, QUERY_EMBEDDING_CACHE_TTL)
+                for key in keys
+            ]
+        
+        # Une requête répétée dans le lot n'est vectorisée qu'une fois
+        missing = list({keys[i]: queries[i] for i, e in enumerate(embeddings) if e is None}.items())
+        if not missing:
+            return embeddings
+        
+        response = await self.openai_client.embeddings.create(
+            model=self.config["embedding_model"],
+            dimensions=self.config["embedding_dimensions"],
+            input=[query for _, query in missing]
+        )
+        computed = {
+            key: d.embedding
+            for (key, _), d in zip(missing, sorted(response.data, key=lambda d: d.index))
+        }
+        
+        async with self._query_embedding_lock:
+            for key, embedding in computed.items():
+                _cache_put(self._query_embedding_cache, key, embedding, QUERY_EMBEDDING_CACHE_SIZE)
+        
+        return [e if e is not None else computed[key] for e, key in zip(embeddings, keys)]
+    
+    def _match_chunks(self, query_embedding: List[float], top_k: int,
+                      filters: Optional[Dict[str, Any]] = None) -> List[Dict[str, Any]]:
+        """Rechercher les chunks les plus proches d'un embedding"""
+        filters = filters or {}
+        
+        # Recherche par produit scalaire via l'index HNSW, filtres appliqués
+        # aux candidats renvoyés par l'index
+        response = self.supabase.rpc(
+            'match_knowledge_chunks',
+            {
+                'query_embedding': query_embedding,
+                'match_threshold': self.config["similarity_threshold"],
+                'match_count': top_k,
+                'ef_search': self.config["hnsw_ef_search"],
+                'filter_doc_type': filters.get("doc_type"),
+                'filter_doc_ids': filters.get("doc_ids")
+            }
+        ).execute()
+        
+        return response.data if response.data else []
+    
+    def _build_prompt(self, question: str,
+                      similar_chunks: List[Dict[str, Any]]) -> Tuple[str, List[Dict[str, Any]], float]:
+        """
+        Construire le prompt système et les sources à partir des chunks retrouvés.
+        
+        Returns:
+            Tuple (prompt système, sources, confiance moyenne)
+        """
+        context_parts = []
+        sources = []
+        
+        for chunk in similar_chunks:
+            context_parts.append(chunk["content"])
+            sources.append({
+                "document": chunk.get("document_name", "Inconnu"),
+                "page": (chunk.get("metadata") or {}).get("page", 1),
+                "score": round(chunk.get("similarity", 0), 3)  # Produit scalaire = cosinus (embeddings normalisés)
+            })
+        
+        context = "\n\n---\n\n".join(context_parts)
+        system_prompt = SYSTEM_PROMPT_PREFIX + context + SYSTEM_PROMPT_MID + question + SYSTEM_PROMPT_SUFFIX
+        
+        # Calculer la confiance moyenne
+        avg_confidence = sum(s["score"] for s in sources) / len(sources) if sources else 0
+        
+        return system_prompt, sources, avg_confidence
+    
+    def _answer_cache_key(self, question: str, similar_chunks: List[Dict[str, Any]]) -> bytes:
+        """Clé du cache de réponses : question normalisée, chunks retrouvés et génération"""
+        return hashlib.blake2b(
+            f"{self._answer_cache_generation}|{question.lower().strip()}|"
+            f"{','.join(sorted(str(c['id']) for c in similar_chunks))}".encode(),
+            digest_size=16
+        ).digest()
+    
+    async def _generate_answer(self, question: str, similar_chunks: List[Dict[str, Any]],
+                         session_id: str = None) -> Dict[str, Any]:
+        """Générer la réponse GPT à partir des chunks retrouvés"""
+        if not similar_chunks:
+            return {
+                "response": NO_ANSWER_MESSAGE,
+                "sources": [],
+                "confidence": 0
+            }
+        
+        # Même question sur les mêmes chunks : réponse déjà générée
+        cache_key = self._answer_cache_key(question, similar_chunks)
+        cached = _cache_get(self._answer_cache, cache_key, ANSWER_CACHE_TTL)
+        if cached is not None:
+            return {**cached, "session_id": session_id or str(uuid.uuid4())}
+        
+        system_prompt, sources, avg_confidence = self._build_prompt(question, similar_chunks)
+        
+        # Générer la réponse avec GPT-4
+        response = await self.openai_client.chat.completions.create(
+            model=self.config["model"],
+            messages=[
+                {"role": "system", "content": system_prompt}
+            ],
+            temperature=0.3,
+            max_tokens=1000
+        )
+        
+        answer = response.choices[0].message.content
+        
+        logger.info("Generated response for query with confidence %.3f", avg_confidence)
+        
+        result = {
+            "response": answer,
+            "sources": sources,
+            "confidence": round(avg_confidence, 3)
+        }
+        _cache_put(self._answer_cache, cache_key, result, ANSWER_CACHE_SIZE)
+        
+        return {**result, "session_id": session_id or str(uuid.uuid4())}
+    
     async def query(self, question: str, session_id: str = None) -> Dict[str, Any]:
         """
         Interroger le système RAG avec une question.
@@ -216,148 +703,229 @@ class SupabaseRAGService:
             # 1. Rechercher les documents pertinents
             similar_chunks = await self.search_similar(question)
             
-            if not similar_chunks:
-                return {
-                    "response": "Je n'ai pas trouvé d'information pertinente dans ma base de connaissances. Je vous invite à contacter le service client au 0770 12 34 56.",
-                    "sources": [],
-                    "confidence": 0
-                }
-            
-            # 2. Construire le contexte
-            context_parts = []
-            sources = []
-            
-            for chunk in similar_chunks:
-                context_parts.append(chunk["content"])
-                sources.append({
-                    "document": chunk.get("document_name", "Inconnu"),
-                    "page": chunk.get("metadata", {}).get("page", 1),
-                    "score": round(1 - chunk.get("similarity", 0), 3)  # Convertir distance en similarité
-                })
+            # 2. Générer la réponse
+            return await self._generate_answer(question, similar_chunks, session_id)
             
-            context = "\n\n---\n\n".join(context_parts)
-            
-            # 3. Générer la réponse avec GPT-4
-            system_prompt = f"""Tu es Aimé, l'assistant virtuel intelligent de la CNSS.
-
-CONTEXTE:
-Tu assistes les assurés de la CNSS pour leurs questions sur les prestations sociales.
-
-RÈGLES STRICTES:
-1. Réponds UNIQUEMENT en français
-2. Base-toi UNIQUEMENT sur le contexte fourni ci-dessous
-3. Si l'information n'est pas dans le contexte, dis "Je n'ai pas trouvé cette information"
-4. Sois professionnel, chaleureux et concis
-5. Ne partage JAMAIS d'informations sensibles
-6. Cite toujours tes sources
-
-CONTEXTE DOCUMENTAIRE:
-{context}
-
-QUESTION DU CLIENT:
-{question}
-
-RÉPONSE:"""
-            
-            response = self.openai_client.chat.completions.create(
-                model=self.config["model"],
-                messages=[
-                    {"role": "system", "content": system_prompt}
-                ],
-                temperature=0.3,
-                max_tokens=1000
-            )
-            
-            answer = response.choices[0].message.content
+        except Exception as e:
+            logger.error("Error in query: %s", e)
+            raise
+    
+    async def stream_query(self, question: str, session_id: str = None) -> AsyncIterator[Dict[str, Any]]:
+        """
+        Interroger le système RAG en diffusant la réponse au fil de sa génération.
+        
+        La recherche est faite avant le début du flux : le premier événement
+        contient les sources et la confiance, les suivants les fragments de la
+        réponse.
+        
+        Args:
+            question: Question de l'utilisateur
+            session_id: ID de session (optionnel)
+        
+        Yields:
+            Événements {"type": "sources" | "token", ...}
+        """
+        similar_chunks = await self.search_similar(question)
+        
+        if not similar_chunks:
+            yield {"type": "sources", "sources": [], "confidence": 0, "session_id": session_id}
+            yield {"type": "token", "content": NO_ANSWER_MESSAGE}
+            return
+        
+        cache_key = self._answer_cache_key(question, similar_chunks)
+        cached = _cache_get(self._answer_cache, cache_key, ANSWER_CACHE_TTL)
+        if cached is not None:
+            yield {
+                "type": "sources",
+                "sources": cached["sources"],
+                "confidence": cached["confidence"],
+                "session_id": session_id
+            }
+            yield {"type": "token", "content": cached["response"]}
+            return
+        
+        system_prompt, sources, avg_confidence = self._build_prompt(question, similar_chunks)
+        
+        yield {
+            "type": "sources",
+            "sources": sources,
+            "confidence": round(avg_confidence, 3),
+            "session_id": session_id
+        }
+        
+        stream = await self.openai_client.chat.completions.create(
+            model=self.config["model"],
+            messages=[
+                {"role": "system", "content": system_prompt}
+            ],
+            temperature=0.3,
+            max_tokens=1000,
+            stream=True
+        )
+        
+        parts = []
+        async for chunk in stream:
+            if chunk.choices and chunk.choices[0].delta.content:
+                parts.append(chunk.choices[0].delta.content)
+                yield {"type": "token", "content": parts[-1]}
+        
+        # Réponse complète : disponible pour /chat comme pour /chat/stream
+        _cache_put(self._answer_cache, cache_key, {
+            "response": "".join(parts),
+            "sources": sources,
+            "confidence": round(avg_confidence, 3)
+        }, ANSWER_CACHE_SIZE)
+    
+    async def query_batch(self, questions: List[str],
+                          session_ids: List[Optional[str]] = None) -> List[Dict[str, Any]]:
+        """
+        Interroger le système RAG avec plusieurs questions.
+        
+        Les questions absentes du cache sont vectorisées en un seul appel
+        d'embeddings, puis les recherches et les générations sont exécutées
+        en parallèle.
+        
+        Args:
+            questions: Questions des utilisateurs
+            session_ids: IDs de session, dans le même ordre (optionnel)
+        
+        Returns:
+            Réponses générées, dans l'ordre des questions
+        """
+        try:
+            session_ids = session_ids or [None] * len(questions)
+            top_k = self.config["top_k"]
             
-            # Calculer la confiance moyenne
-            avg_confidence = sum(s["score"] for s in sources) / len(sources) if sources else 0
+            # 1. Embeddings depuis le cache, un seul appel pour les autres
+            embeddings = await self._get_query_embeddings(questions)
             
-            logger.info(f"Generated response for query with confidence {avg_confidence:.3f}")
+            # 2. Recherches en parallèle
+            results = await asyncio.gather(*[
+                self._run(self._match_chunks, embedding, top_k)
+                for embedding in embeddings
+            ])
             
-            return {
-                "response": answer,
-                "sources": sources,
-                "confidence": round(avg_confidence, 3),
-                "session_id": session_id or str(uuid.uuid4())
-            }
+            # 3. Générations en parallèle
+            return await asyncio.gather(*[
+                self._generate_answer(question, chunks, session_id)
+                for question, chunks, session_id in zip(questions, results, session_ids)
+            ])
             
         except Exception as e:
-            logger.error(f"Error in query: {e}")
+            logger.error("Error in batch query: %s", e)
             raise
     
     async def list_documents(self) -> List[Dict[str, Any]]:
         """Lister tous les documents indexés"""
         try:
-            response = self.supabase.table("knowledge_documents").select("*").order("created_at", desc=True).execute()
+            response = await self._run(self.supabase.table("knowledge_documents").select("*").order("created_at", desc=True).execute)
             return response.data if response.data else []
         except Exception as e:
-            logger.error(f"Error listing documents: {e}")
+            logger.error("Error listing documents: %s", e)
             raise
     
     async def get_document(self, doc_id: str) -> Optional[Dict[str, Any]]:
         """Récupérer un document par son ID"""
         try:
-            response = self.supabase.table("knowledge_documents").select("*").eq("id", doc_id).single().execute()
+            response = await self._run(self.supabase.table("knowledge_documents").select("*").eq("id", doc_id).single().execute)
             return response.data
         except Exception as e:
-            logger.error(f"Error getting document {doc_id}: {e}")
+            logger.error("Error getting document %s: %s", doc_id, e)
             return None
     
     async def delete_document(self, doc_id: str) -> bool:
         """Supprimer un document et ses chunks"""
         try:
-            # Supprimer les chunks d'abord
-            self.supabase.table("knowledge_chunks").delete().eq("document_id", doc_id).execute()
+            # Les chunks sont supprimés par la clé étrangère ON DELETE CASCADE
+            await self._run(self.supabase.table("knowledge_documents").delete().eq("id", doc_id).execute)
+            
+            # Invalider les réponses en cache qui pourraient citer ce document
+            self._answer_cache_generation += 1
+            self._answer_cache.clear()
             
-            # Supprimer le document
-            self.supabase.table("knowledge_documents").delete().eq("id", doc_id).execute()
+            logger.info("Document %s deleted", doc_id)
             
-            logger.info(f"Document {doc_id} deleted")
+            await self.refresh_hnsw_params()
             return True
             
         except Exception as e:
-            logger.error(f"Error deleting document {doc_id}: {e}")
+            logger.error("Error deleting document %s: %s", doc_id, e)
             raise
     
+    def _configure_hnsw_params(self, vector_count: int) -> Dict[str, int]:
+        """
+        Choisir ef_search selon le nombre de vecteurs indexés.
+        
+        La valeur n'est appliquée aux recherches que si l'ajustement
+        automatique est actif (HNSW_EF_SEARCH non défini).
+        """
+        for max_count, ef_search in HNSW_TIERS:
+            if vector_count <= max_count:
+                break
+        
+        if self.config["hnsw_auto_tune"]:
+            self.config["hnsw_ef_search"] = max(ef_search, self.config["top_k"])
+        
+        return {
+            "m": HNSW_M,
+            "ef_construction": HNSW_EF_CONSTRUCTION,
+            "ef_search": self.config["hnsw_ef_search"]
+        }
+    
+    async def refresh_hnsw_params(self) -> Dict[str, int]:
+        """
+        Ajuster ef_search à la taille actuelle du corpus.
+        
+        Appelé au démarrage et après chaque ajout ou suppression de document.
+        En cas d'erreur, la valeur courante est conservée.
+        """
+        try:
+            response = await self._run(self.supabase.rpc('rag_stats').execute)
+            self.hnsw_params = self._configure_hnsw_params((response.data or {}).get("total_chunks", 0))
+            logger.info("HNSW ef_search set to %s", self.hnsw_params["ef_search"])
+        except Exception as e:
+            logger.warning("Could not refresh HNSW parameters, keeping ef_search=%s: %s",
+                           self.config["hnsw_ef_search"], e)
+        
+        return self.hnsw_params
+    
     async def get_stats(self) -> Dict[str, Any]:
         """Récupérer les statistiques du RAG"""
         try:
-            # Compter les documents
-            docs_response = self.supabase.table("knowledge_documents").select("*", count="exact").execute()
-            total_docs = docs_response.count if hasattr(docs_response, 'count') else 0
-            
-            # Compter les chunks
-            chunks_response = self.supabase.table("knowledge_chunks").select("*", count="exact").execute()
-            total_chunks = chunks_response.count if hasattr(chunks_response, 'count') else 0
-            
-            # Documents par statut
-            status_response = self.supabase.table("knowledge_documents").select("status").execute()
-            status_counts = {}
-            for doc in status_response.data or []:
-                status = doc.get("status", "UNKNOWN")
-                status_counts[status] = status_counts.get(status, 0) + 1
+            # Comptages agrégés côté serveur en un seul appel
+            response = await self._run(self.supabase.rpc('rag_stats').execute)
+            stats = response.data or {}
             
             return {
-                "total_documents": total_docs,
-                "total_chunks": total_chunks,
-                "status_breakdown": status_counts,
+                "total_documents": stats.get("total_documents", 0),
+                "total_chunks": stats.get("total_chunks", 0),
+                "status_breakdown": stats.get("status_breakdown", {}),
+                "hnsw_params": self.hnsw_params,
                 "config": self.config
             }
             
         except Exception as e:
-            logger.error(f"Error getting stats: {e}")
+            logger.error("Error getting stats: %s", e)
             raise
     
     def update_config(self, new_config: Dict[str, Any]):
         """Mettre à jour la configuration"""
+        if "embedding_dimensions" in new_config:
+            _check_embedding_dimensions(new_config["embedding_dimensions"])
+        
         self.config.update(new_config)
         
         # Mettre à jour le text splitter si nécessaire
         if "chunk_size" in new_config or "chunk_overlap" in new_config:
             self._init_text_splitter()
         
-        logger.info(f"Configuration updated: {self.config}")
+        # Les embeddings en cache ne correspondent plus au nouveau modèle
+        if "embedding_model" in new_config or "embedding_dimensions" in new_config:
+            self._query_embedding_cache.clear()
+        
+        self._answer_cache.clear()
+        
+        logger.info("Configuration updated: %s", self.config)
     
     def get_config(self) -> Dict[str, Any]:
         """Récupérer la configuration actuelle"""
@@ -1,11 +1,56 @@
--- Note: Index vectoriel omis pour le moment (3072 dims > limite 2000 de pgvector)
--- En production, utiliser text-embedding-3-small (1536 dims) ou réduire les dimensions
+-- hnsw.iterative_scan n'existe qu'à partir de pgvector 0.8.0 : sur une
+-- version antérieure, set_config échouerait à chaque recherche
+DO $$
+BEGIN
+    IF (SELECT string_to_array(extversion, '.')::int[] FROM pg_extension WHERE extname = 'vector')
+        < ARRAY[0, 8, 0] THEN
+        RAISE EXCEPTION 'pgvector >= 0.8.0 requis (ALTER EXTENSION vector UPDATE)';
+    END IF;
+END;
+$$;
+
+-- Embeddings stockés en halfvec (FP16) : moitié moins de mémoire et d'I/O.
+-- Réduits à 1024 dimensions (Matryoshka) : les 1024 premières composantes
+-- renormalisées équivalent à un appel OpenAI avec dimensions=1024.
+DROP INDEX IF EXISTS "idx_knowledge_chunks_embedding_hnsw";
+
+ALTER TABLE knowledge_chunks
+    ALTER COLUMN embedding TYPE halfvec(1024)
+    USING l2_normalize(subvector(embedding, 1, 1024))::halfvec(1024);
+
+-- Métadonnées communes à tous les chunks d'un document (jamais NULL :
+-- la fusion jsonb || renverrait NULL)
+ALTER TABLE knowledge_documents
+    ADD COLUMN IF NOT EXISTS metadata JSONB DEFAULT '{}';
+UPDATE knowledge_documents SET metadata = '{}' WHERE metadata IS NULL;
+ALTER TABLE knowledge_documents
+    ALTER COLUMN metadata SET NOT NULL;
+
+-- Index vectoriel HNSW pour la recherche sémantique (construction
+-- parallèle et en mémoire du graphe)
+SET max_parallel_maintenance_workers = 7;
+SET maintenance_work_mem = '2GB';
+
+CREATE INDEX IF NOT EXISTS "idx_knowledge_chunks_embedding_hnsw"
+    ON "knowledge_chunks"
+    USING hnsw (embedding halfvec_ip_ops)
+    WITH (m = 24, ef_construction = 128);
+
+RESET max_parallel_maintenance_workers;
+RESET maintenance_work_mem;
 
 -- Fonction de recherche vectorielle
+DROP FUNCTION IF EXISTS match_knowledge_chunks(vector, float, int);
+DROP FUNCTION IF EXISTS match_knowledge_chunks(vector, float, int, int);
+DROP FUNCTION IF EXISTS match_knowledge_chunks(halfvec, float, int, int);
+
 CREATE OR REPLACE FUNCTION match_knowledge_chunks(
-    query_embedding vector(3072),
+    query_embedding halfvec(1024),
     match_threshold float DEFAULT 0.75,
-    match_count int DEFAULT 5
+    match_count int DEFAULT 5,
+    ef_search int DEFAULT 100,
+    filter_doc_type text DEFAULT NULL,
+    filter_doc_ids uuid[] DEFAULT NULL
 )
 RETURNS TABLE(
     id uuid,
@@ -18,22 +63,76 @@ RETURNS TABLE(
 LANGUAGE plpgsql
 AS $$
 BEGIN
+    -- Taille de la liste de candidats HNSW, limitée à la transaction courante
+    PERFORM set_config('hnsw.ef_search', ef_search::text, true);
+    -- Parcours itératif (pgvector >= 0.8) : tant que les filtres écartent
+    -- des candidats, l'index continue d'en fournir jusqu'à obtenir
+    -- match_count lignes
+    PERFORM set_config('hnsw.iterative_scan', 'relaxed_order', true);
+
+    -- <#> renvoie l'opposé du produit scalaire (embeddings normalisés).
+    -- En relaxed_order l'ordre de l'index est approximatif : les candidats
+    -- sont matérialisés puis triés à nouveau.
     RETURN QUERY
+    WITH candidates AS MATERIALIZED (
+        SELECT
+            kc.id,
+            kc.document_id,
+            kc.content,
+            kc.metadata,
+            kc.embedding <#> query_embedding AS distance
+        FROM knowledge_chunks kc
+        WHERE (filter_doc_ids IS NULL OR kc.document_id = ANY(filter_doc_ids))
+          AND (filter_doc_type IS NULL OR kc.document_id IN (
+              SELECT kd_type.id FROM knowledge_documents kd_type
+              WHERE kd_type.type = filter_doc_type
+          ))
+        ORDER BY kc.embedding <#> query_embedding
+        LIMIT match_count
+    )
     SELECT
-        kc.id,
-        kc.document_id,
-        kc.content,
-        kc.metadata,
-        (1 - (kc.embedding <=> query_embedding))::float as similarity,
+        c.id,
+        c.document_id,
+        c.content,
+        -- Métadonnées du document complétées par celles propres au chunk
+        COALESCE(kd.metadata, '{}') || COALESCE(c.metadata, '{}') as metadata,
+        (-c.distance)::float as similarity,
         kd.name as document_name
-    FROM knowledge_chunks kc
-    JOIN knowledge_documents kd ON kc.document_id = kd.id
-    WHERE 1 - (kc.embedding <=> query_embedding) > match_threshold
-    ORDER BY kc.embedding <=> query_embedding
-    LIMIT match_count;
+    FROM candidates c
+    JOIN knowledge_documents kd ON c.document_id = kd.id
+    WHERE -c.distance > match_threshold
+    ORDER BY c.distance;
 END;
 $$;
 
+-- Statistiques RAG (agrégées côté serveur)
+CREATE OR REPLACE FUNCTION rag_stats()
+RETURNS json
+LANGUAGE sql
+STABLE
+AS $$
+    SELECT json_build_object(
+        'total_documents', (SELECT count(*) FROM knowledge_documents),
+        'total_chunks', (SELECT count(*) FROM knowledge_chunks),
+        'status_breakdown', COALESCE(
+            (SELECT json_object_agg(status, c)
+             FROM (SELECT COALESCE(status, 'UNKNOWN') AS status, count(*) AS c
+                   FROM knowledge_documents GROUP BY 1) s),
+            '{}'::json
+        )
+    );
+$$;
+
+-- Finalisation de l'indexation d'un document
+CREATE OR REPLACE FUNCTION finalize_document(doc_id uuid)
+RETURNS void
+LANGUAGE sql
+AS $$
+    UPDATE knowledge_documents
+    SET status = 'INDEXED', indexed_at = NOW()
+    WHERE id = doc_id;
+$$;
+
 -- Trigger pour compter les chunks
 CREATE OR REPLACE FUNCTION update_document_chunks_count()
 RETURNS TRIGGER LANGUAGE plpgsql AS $$